@@ -16,15 +16,15 @@ import re
 import os
 import sqlite3
 from collections import deque
+from difflib import SequenceMatcher
+from functools import lru_cache
 from hashlib import sha1
 from typing import Any, Dict, List, Optional
 
-import pytz
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import JSONResponse, PlainTextResponse
 from telegram import Bot, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.error import RetryAfter, Forbidden
-from difflib import SequenceMatcher
 
 # ---- конфиг ----
 config = configparser.ConfigParser()
@@ -63,23 +63,39 @@ NOTIFY_STATUSES: set[int] = {
 }
 IN_WORK_STATUS: int = int(config.get("App", "in_work_status_id", fallback="106951"))
 
+# уровень — из LOG_LEVEL, той же картой, что в main.py (getLevelNamesMapping есть только с 3.11,
+# а образ может собираться на pypy:3.10); тело вебхука пишется только на DEBUG
+_LEVEL_MAP = {
+    "CRITICAL": logging.CRITICAL,
+    "ERROR": logging.ERROR,
+    "WARNING": logging.WARNING,
+    "INFO": logging.INFO,
+    "DEBUG": logging.DEBUG,
+}
 logging.basicConfig(
-    level=logging.INFO,
+    level=_LEVEL_MAP.get(os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO),
     format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
 )
 log = logging.getLogger("idk_webhook")
-UTC = pytz.UTC
+UTC = datetime.timezone.utc
 
 # ---- DB ----
-import os
-# остальные импорты...
 
 def get_db() -> sqlite3.Connection:
     # создаём каталог под БД, если его нет
     os.makedirs(os.path.dirname(DB_FILE) or ".", exist_ok=True)
 
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    # кэш подготовленных выражений по тексту SQL (как в main.py): все запросы модуля —
+    # константные строки, в т.ч. UPDATE из update_ticket с фиксированным набором assignments
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row
+    # те же настройки, что у main.py: база общая, бот пишет в неё параллельно
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA mmap_size=268435456")
     with conn:
         conn.execute(
             """
@@ -100,6 +116,29 @@ def get_db() -> sqlite3.Connection:
             )
             """
         )
+        # архив закрытых заявок; переносят триггеры, которые создаёт main.py (init_db)
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tickets_archive(
+                ticket_id TEXT PRIMARY KEY,
+                task_number TEXT,
+                chat_id INTEGER,
+                user_id INTEGER,
+                message_id INTEGER,
+                last_user_message_id INTEGER,
+                last_updated TEXT,
+                status INTEGER,
+                last_comment TEXT,
+                notified_status INTEGER,
+                last_engineer_comment TEXT,
+                last_notified_reminder TEXT,
+                status_changed_at TEXT
+            )
+            """
+        )
+        conn.execute(
+            "CREATE VIEW IF NOT EXISTS tickets_all AS SELECT * FROM tickets UNION ALL SELECT * FROM tickets_archive"
+        )
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS user_comments(
@@ -121,34 +160,60 @@ def get_ticket_row(ticket_id: str) -> Optional[sqlite3.Row]:
     return DB.execute(
         """
         SELECT ticket_id, task_number, chat_id, user_id, last_user_message_id, status
-        FROM tickets
+        FROM tickets_all
         WHERE ticket_id = ?
         """,
         (ticket_id,),
     ).fetchone()
 
 
+def update_ticket(ticket_id: str, assignments: str, params: tuple) -> None:
+    """UPDATE заявки в обеих таблицах: закрытая заявка уже может лежать в tickets_archive."""
+    with DB:
+        for table in ("tickets", "tickets_archive"):
+            DB.execute(f"UPDATE {table} SET {assignments} WHERE ticket_id = ?", (*params, ticket_id))
+
+
 def clear_user_comments(ticket_id: str) -> None:
     with DB:
         DB.execute("DELETE FROM user_comments WHERE ticket_id = ?", (ticket_id,))
 
 
 # ---- анти-эхо ----
+# нормализация зовётся для каждого сохранённого комментария заявки на каждый вебхук — шаблоны
+# компилируются один раз (флаг re.UNICODE для str-шаблонов и так по умолчанию)
+_INVISIBLE_RE = re.compile(r"[\u200B\u200C\u200D\uFE0E\uFE0F]")  # скрытые селекторы/ZWJ
+_WS_RE = re.compile(r"\s+")
+# есть ли вообще что нормализовать: скрытые символы, пробелы подряд или не-пробельный whitespace
+_NEEDS_NORM_RE = re.compile(r"[\u200B\u200C\u200D\uFE0E\uFE0F]|\s\s|[^\S ]")
+_NON_WORD_RE = re.compile(r"[\W_]+")
+
+
 def _normalize_for_db(s: Optional[str]) -> str:
     """Мягкая нормализация: убираем VS/ZWJ, схлопываем пробелы, приводим к нижнему регистру."""
     if not s:
         return ""
-    s = str(s)
-    s = re.sub(r"[\u200B\u200C\u200D\uFE0E\uFE0F]", "", s)  # скрытые селекторы/ZWJ
-    s = re.sub(r"\r\n?", "\n", s)
-    s = re.sub(r"\s+", " ", s, flags=re.UNICODE).strip()
+    return _normalize_soft(s if isinstance(s, str) else str(s))
+
+
+# Сохранённые комментарии заявки сравниваются с каждым её вебхуком — одни и те же строки
+# нормализуются снова и снова, поэтому результаты кэшируются (строки неизменяемы)
+@lru_cache(maxsize=4096)
+def _normalize_soft(s: str) -> str:
+    if _NEEDS_NORM_RE.search(s) is None:
+        # обычный комментарий: один проход вместо трёх sub
+        return s.strip().lower()
+    s = _INVISIBLE_RE.sub("", s)
+    # \r и \n — тоже \s: отдельный проход для CRLF не нужен, всё схлопнется в пробел
+    s = _WS_RE.sub(" ", s).strip()
     return s.lower()
 
 
+@lru_cache(maxsize=4096)
 def _normalize_strict(s: Optional[str]) -> str:
     """Строгая нормализация: оставляем только буквы и цифры (для substring/ratio-сравнений)."""
     soft = _normalize_for_db(s)
-    return re.sub(r"[\W_]+", "", soft, flags=re.UNICODE)
+    return _NON_WORD_RE.sub("", soft)
 
 
 def user_comment_exists(ticket_id: str, text: str) -> bool:
@@ -201,18 +266,18 @@ def save_user_comment_db(ticket_id: str, text: str) -> None:
 
 def update_ticket_status(ticket_id: str, new_status: Optional[int]) -> bool:
     row = DB.execute(
-        "SELECT status FROM tickets WHERE ticket_id = ?",
+        "SELECT status FROM tickets_all WHERE ticket_id = ?",
         (ticket_id,),
     ).fetchone()
     if not row:
         return False
     old = row["status"]
     changed = new_status is not None and old != new_status
-    with DB:
-        DB.execute(
-            "UPDATE tickets SET status = COALESCE(?, status), last_updated = ? WHERE ticket_id = ?",
-            (new_status, datetime.datetime.now(UTC).isoformat(), ticket_id),
-        )
+    update_ticket(
+        ticket_id,
+        "status = COALESCE(?, status), last_updated = ?",
+        (new_status, datetime.datetime.now(UTC).isoformat()),
+    )
     if changed:
         log.info(
             "Status changed for ticket %s: %s -> %s (%s)",
@@ -231,22 +296,31 @@ def _reply_kwargs(chat_id: int, reply_to_message_id: Optional[int]) -> Dict[str,
 
 
 # ---- utils ----
+# регэкспы компилируются один раз: clean_intradesk_html/chunk_text зовутся на каждый комментарий
+_BR_RE = re.compile(r"(?i)<br\s*/?>")
+# покрывает и служебные <intradesk-...> теги, отдельный проход для них не нужен
+_TAG_RE = re.compile(r"<[^>]+>")
+_CRLF_RE = re.compile(r"\r\n?")
+_HSPACE_RE = re.compile(r"[ \t]+")
+_MANY_NL_RE = re.compile(r"\n{3,}")
+_CHUNK_SPLIT_RE = re.compile(r"(\n\n+|(?<=\.)\s)")
+
+
 def clean_intradesk_html(s: str) -> str:
     if not s:
         return ""
     t = s
     if len(t) >= 2 and t[0] == '"' and t[-1] == '"':
         t = t[1:-1]
-    t = re.sub(r"(?i)<br\s*/?>", "\n", t)
-    t = re.sub(r"</?intradesk[-\w:]+[^>]*>", "", t)
-    t = re.sub(r"<[^>]+>", "", t)
+    t = _BR_RE.sub("\n", t)
+    t = _TAG_RE.sub("", t)
     try:
         t = html.unescape(t)
     except Exception:
         pass
-    t = re.sub(r"\r\n?", "\n", t)
-    t = re.sub(r"[ \t]+", " ", t)
-    t = re.sub(r"\n{3,}", "\n\n", t).strip()
+    t = _CRLF_RE.sub("\n", t)
+    t = _HSPACE_RE.sub(" ", t)
+    t = _MANY_NL_RE.sub("\n\n", t).strip()
     return t
 
 
@@ -255,7 +329,7 @@ def chunk_text(text: str, limit: int = TG_LIMIT) -> List[str]:
         return [text]
     parts: List[str] = []
     buf = ""
-    for seg in re.split(r"(\n\n+|(?<=\.)\s)", text):
+    for seg in _CHUNK_SPLIT_RE.split(text):
         if not seg:
             continue
         if len(buf) + len(seg) <= limit:
@@ -417,6 +491,9 @@ def pick_status(payload: Dict[str, Any]) -> Optional[int]:
     fields = payload.get("Fields") or payload.get("fields") or {}
     status_block = fields.get("status") or fields.get("Status") or None
     if isinstance(status_block, str):
+        # обычно статус приходит голым числом — без json.loads
+        if status_block.isascii() and status_block.isdigit():
+            return int(status_block)
         parsed = try_parse_json_maybe_escaped(status_block)
         if isinstance(parsed, dict):
             for k in ("Id", "id", "Value", "value"):
@@ -465,12 +542,15 @@ async def idk_webhook(request: Request):
         return JSONResponse({"ok": True, "duplicate": True})
 
     # парсинг JSON
+    body = raw.decode("utf-8", errors="replace")
     try:
-        payload = json.loads(raw.decode("utf-8", errors="replace"))
+        payload = json.loads(body)
     except Exception:
         payload = await request.json()
 
-    log.info("Webhook: %s", json.dumps(payload, ensure_ascii=False)[:1200])
+    # в лог — срез уже раскодированного тела, без повторной сериализации всего payload
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Webhook: %s", body[:1200])
 
     # определяем ticket_id
     ticket_id: Optional[str] = None
@@ -510,7 +590,7 @@ async def idk_webhook(request: Request):
     # 2) Если статус стал "в работе" — отправляем уведомление (однократно)
     if status_changed and status == IN_WORK_STATUS:
         notified_val = DB.execute(
-            "SELECT notified_status FROM tickets WHERE ticket_id = ?",
+            "SELECT notified_status FROM tickets_all WHERE ticket_id = ?",
             (ticket_id,),
         ).fetchone()
         already_notified = bool(
@@ -521,16 +601,12 @@ async def idk_webhook(request: Request):
             inwork_text = f"Заявка #{task_number or '—'} принята в работу."
             await tg_send(BOT, chat_id, inwork_text, reply_to_message_id=reply_to_id)
             now_iso = datetime.datetime.now(UTC).isoformat()
-            with DB:
-                DB.execute(
-                    "UPDATE tickets SET notified_status = ?, status_changed_at = ? WHERE ticket_id = ?",
-                    (int(status), now_iso, ticket_id),
-                )
+            update_ticket(ticket_id, "notified_status = ?, status_changed_at = ?", (int(status), now_iso))
     
     # 2.1) Если статус стал "требует уточнения" — отправляем просьбу ответить (однократно)
     if status_changed and status in NOTIFY_STATUSES:
         notified_val = DB.execute(
-            "SELECT notified_status FROM tickets WHERE ticket_id = ?",
+            "SELECT notified_status FROM tickets_all WHERE ticket_id = ?",
             (ticket_id,),
         ).fetchone()
         already_notified = bool(
@@ -544,11 +620,7 @@ async def idk_webhook(request: Request):
             )
             await tg_send(BOT, chat_id, notify_text, reply_to_message_id=reply_to_id)
             now_iso = datetime.datetime.now(UTC).isoformat()
-            with DB:
-                DB.execute(
-                    "UPDATE tickets SET notified_status = ?, status_changed_at = ? WHERE ticket_id = ?",
-                    (int(status), now_iso, ticket_id),
-                )
+            update_ticket(ticket_id, "notified_status = ?, status_changed_at = ?", (int(status), now_iso))
 
     # 3) Если статус финальный — отправляем опрос оценки (после комментария/уведомления)
     if status_changed and status in RATING_FINAL_STATUSES:
@@ -562,11 +634,7 @@ async def idk_webhook(request: Request):
                 BOT, chat_id, ticket_id, task_number, owner_user_id, reply_to_message_id=reply_to_id
             )
             if message_id:
-                with DB:
-                    DB.execute(
-                        "UPDATE tickets SET message_id = ? WHERE ticket_id = ?",
-                        (message_id, ticket_id),
-                    )
+                update_ticket(ticket_id, "message_id = ?", (message_id,))
 
     # Чистим кэш пользовательских комментов при финальных статусах
     if status is not None and status in FINAL_STATUSES:
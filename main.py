@@ -9,19 +9,29 @@ Telegram → IntraDesk bot (webhook mode for Docker/NPM), keeping original logic
 from __future__ import annotations
 
 import asyncio
+import atexit
 import configparser
 import datetime as dt
 import html
+import json
 import logging
 import os
+import platform
+import queue
 import re
 import sqlite3
 import sys
-from typing import Any, Dict, Optional, Tuple
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional, Tuple
 
-import pytz
 import requests
-from tenacity import retry, stop_after_attempt, wait_fixed
+from requests.adapters import HTTPAdapter
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential, wait_random
 from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -58,10 +68,25 @@ log_level = _LEVEL_MAP.get(log_level_name, logging.INFO)
 
 
 
+# Обработчики и потоки бота только кладут запись в очередь; запись на диск и в консоль —
+# в фоновом потоке QueueListener. Размер лога ограничивает ротация (вместо ночной очистки).
+LOG_MAX_BYTES = 10_000_000
+LOG_BACKUP_COUNT = 3
+
+_LOG_QUEUE: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+_LOG_LISTENER = QueueListener(
+    _LOG_QUEUE,
+    RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"),
+    logging.StreamHandler(),
+)
+_LOG_LISTENER.start()
+atexit.register(_LOG_LISTENER.stop)
+
+# QueueHandler форматирует запись сам (формат из basicConfig), целевые обработчики пишут готовую строку
 logging.basicConfig(
     level=log_level,
     format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[logging.FileHandler(LOG_FILE), logging.StreamHandler()],
+    handlers=[QueueHandler(_LOG_QUEUE)],
 )
 logger = logging.getLogger("helptp")
 
@@ -93,19 +118,30 @@ TASKS_ODATA_URL = _CFG_TASKLIST_URL if "/odata/" in _CFG_TASKLIST_URL else f"{IN
 INTRADESK_LEGAL_ENTITIES_URL: str = f"{INTRADESK_URL}/settings/api/v3/clients/LegalEntities"
 INTRADESK_LEGAL_USERS_URL: str = f"{INTRADESK_URL}/settings/api/v3/clients/LegalEntities/Users"
 
-# App
-DB_FILE: str = config["App"].get("db_file", "/data/tickets.db").strip()
-OPEN_STATUS_ID: int = int(config["App"].get("open_status_id", "106939"))
-REOPEN_STATUSES: set[int] = {int(x) for x in re.split(r"[,\s]+", config["App"].get("reopen_statuses", "106941,106940,106948").strip()) if x}
-FINAL_STATUSES: set[int] = {int(x) for x in re.split(r"[,\s]+", config["App"].get("final_statuses", "106950,106949,106946").strip()) if x}
-NOTIFY_STATUSES: set[int] = {int(x) for x in re.split(r"[,\s]+", config["App"].get("notify_statuses", "106948").strip()) if x}
+# App — секция читается один раз, списки статусов разбираются одним хелпером
+_APP_CFG = config["App"]
+_ID_LIST_SPLIT_RE = re.compile(r"[,\s]+")
+
+
+def _parse_status_ids(raw: str) -> frozenset[int]:
+    """'106950, 106949 106946' -> frozenset({106950, 106949, 106946})"""
+    return frozenset(int(x) for x in _ID_LIST_SPLIT_RE.split(raw.strip()) if x)
+
+
+DB_FILE: str = _APP_CFG.get("db_file", "/data/tickets.db").strip()
+OPEN_STATUS_ID: int = int(_APP_CFG.get("open_status_id", "106939"))
+REOPEN_STATUSES: frozenset[int] = _parse_status_ids(_APP_CFG.get("reopen_statuses", "106941,106940,106948"))
+FINAL_STATUSES: frozenset[int] = _parse_status_ids(_APP_CFG.get("final_statuses", "106950,106949,106946"))
+NOTIFY_STATUSES: frozenset[int] = _parse_status_ids(_APP_CFG.get("notify_statuses", "106948"))
+
+# Готовые параметры для "status NOT IN (...)": плейсхолдеры и значения считаются один раз
+FINAL_STATUSES_TUPLE: Tuple[int, ...] = tuple(sorted(FINAL_STATUSES))
+FINAL_STATUSES_SQL_PLACEHOLDERS: str = ",".join("?" * len(FINAL_STATUSES_TUPLE))
 
 # создаём каталог под БД, если его нет
 db_dir = os.path.dirname(DB_FILE) or "."
 os.makedirs(db_dir, exist_ok=True)
 
-conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-
 # === Автоперевод статуса при комментарии пользователя ===
 def _parse_status_map(raw: str) -> Dict[int, int]:
     """'106940->106939,106948->106939' -> {106940:106939, 106948:106939}"""
@@ -113,7 +149,7 @@ def _parse_status_map(raw: str) -> Dict[int, int]:
     raw = (raw or "").strip()
     if not raw:
         return mapping
-    for token in re.split(r"[,\s]+", raw):
+    for token in _ID_LIST_SPLIT_RE.split(raw):
         if not token:
             continue
         if "->" in token:
@@ -130,11 +166,15 @@ def _parse_status_map(raw: str) -> Dict[int, int]:
 
 # По умолчанию: 106940|106948 -> 106939. Можно переопределить в [App] config.ini.
 REOPEN_MAP_ON_COMMENT: Dict[int, int] = _parse_status_map(
-    config["App"].get("reopen_map_on_comment", "106940->106939,106948->106939")
+    _APP_CFG.get("reopen_map_on_comment", "106940->106939,106948->106939")
 )
 
 # Вкл/выкл периодический опрос IntraDesk (cron)
-ENABLE_STATUS_POLLING: bool = config["App"].getboolean("enable_status_polling", fallback=False)
+ENABLE_STATUS_POLLING: bool = _APP_CFG.getboolean("enable_status_polling", fallback=False)
+# Сколько заявок опрос обрабатывает одновременно (лимиты Telegram на флуд)
+POLL_CONCURRENCY: int = _APP_CFG.getint("poll_concurrency", fallback=20)
+# Read-only соединения для чтений, не мешающих записи (WAL)
+DB_READ_POOL_SIZE: int = _APP_CFG.getint("db_read_pool_size", fallback=8)
 
 
 # Webhook / Web
@@ -170,54 +210,224 @@ EVALUATION_MAPPING: Dict[str, Dict[str, Any]] = {
     "1": {"id": 32990, "text": "Плохо"},
 }
 
+# Главное меню: объекты PTB неизменяемы, одну разметку можно отдавать во все сообщения
+MAIN_KEYBOARD = ReplyKeyboardMarkup(
+    [[KeyboardButton("Создать заявку"), KeyboardButton("Открытые заявки")]],
+    resize_keyboard=True,
+    one_time_keyboard=False,
+)
+
 # ==========================
 # Utilities
 # ==========================
 
 def check_single_instance() -> None:
-    if os.path.exists(LOCK_FILE):
+    my_pid = str(os.getpid())
+    # O_EXCL: создание lock атомарно, из двух одновременных запусков файл создаст только один
+    try:
+        fd = os.open(LOCK_FILE, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        pass
+    else:
+        try:
+            os.write(fd, my_pid.encode())
+        finally:
+            os.close(fd)
+        return
+
+    # lock уже есть: мусор в нём — считаем, что живого владельца нет
+    try:
+        with open(LOCK_FILE, "r") as f:
+            pid: Optional[int] = int(f.read().strip())
+    except (OSError, ValueError):
+        pid = None
+    # свой PID в lock — остаток прошлого запуска (в контейнере после рестарта бот снова PID 1)
+    if pid is not None and pid != os.getpid():
         try:
-            with open(LOCK_FILE, "r") as f:
-                pid = int(f.read().strip())
             os.kill(pid, 0)
+        except OSError:
+            pass  # процесса уже нет — lock устарел
+        else:
             print(f"Бот уже запущен с PID {pid}. Завершите его перед новым запуском.")
             sys.exit(1)
-        except Exception:
-            pass
-    with open(LOCK_FILE, "w") as f:
-        f.write(str(os.getpid()))
+    # устаревший lock подменяем атомарно: пишем во временный файл и переименовываем поверх
+    tmp = f"{LOCK_FILE}.{my_pid}.tmp"
+    with open(tmp, "w") as f:
+        f.write(my_pid)
+    os.replace(tmp, LOCK_FILE)
 
 
 def remove_lock_file() -> None:
     try:
-        if os.path.exists(LOCK_FILE):
-            os.remove(LOCK_FILE)
-    except Exception:
+        os.unlink(LOCK_FILE)
+    except FileNotFoundError:
         pass
+    except OSError as e:
+        logger.warning("Не удалось удалить lock-файл %s: %s", LOCK_FILE, e)
 
 
-def clear_logs_job(_: ContextTypes.DEFAULT_TYPE) -> None:
-    try:
-        with open(LOG_FILE, "w"):
-            pass
-        logger.info("Лог-файл очищен")
-    except Exception as e:
-        logger.error(f"Ошибка очистки логов: {e}")
+def escape_html(text: Any) -> str:
+    s = str(text)
+    # обычно спецсимволов нет: пять проверок `in` дешевле пяти replace внутри html.escape
+    if "&" in s or "<" in s or ">" in s or '"' in s or "'" in s:
+        return html.escape(s)
+    return s
 
 
-def escape_html(text: Any) -> str:
-    return html.escape(str(text))
+def _resp_text(e: requests.RequestException) -> str:
+    # у RequestException атрибут response есть всегда (None, если ответа не было);
+    # сравниваем с None: bool(Response) ложен для 4xx/5xx, а тело нужно именно там
+    resp = e.response
+    return resp.text if resp is not None else "<no response>"
+
+
+# Допустимая длина ИНН: 10 цифр (организация) или 12 (ИП)
+_INN_LENS = (10, 12)
 
 
 # ==========================
 # DB
 # ==========================
 
-def init_db(conn: sqlite3.Connection) -> None:
-    with conn:
-        c = conn.cursor()
-        c.execute(
-            """CREATE TABLE IF NOT EXISTS tickets (
+# Соединение работает в autocommit (isolation_level=None): модуль sqlite3 не вставляет
+# неявный BEGIN, а пишущие блоки сами берут RESERVED-лок через BEGIN IMMEDIATE.
+_TX_LOCK = threading.RLock()
+
+# Кэш подготовленных выражений sqlite3 (по тексту SQL) и кэш страниц (~20 МБ) на соединение
+_SQL_CACHED_STATEMENTS = 256
+_SQL_CACHE_SIZE_KIB = 20000
+# Чтения через mmap (до 256 МБ) вместо read() в буфер страниц; mmap общий для всех соединений процесса
+_SQL_MMAP_SIZE = 268435456
+
+
+def connect_db(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, cached_statements=_SQL_CACHED_STATEMENTS)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute(f"PRAGMA cache_size=-{_SQL_CACHE_SIZE_KIB}")
+    conn.execute(f"PRAGMA mmap_size={_SQL_MMAP_SIZE}")
+    # WAL: читатели не блокируют писателя; NORMAL — fsync только на чекпоинте, не на каждом COMMIT
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA wal_autocheckpoint=1000")
+    return conn
+
+
+class ReadPool:
+    """Пул read-only соединений (mode=ro): чтения идут в своих потоках параллельно с записью."""
+
+    def __init__(self, path: str, size: int) -> None:
+        uri = f"file:{os.path.abspath(path)}?mode=ro"
+        self._conns: queue.SimpleQueue[sqlite3.Connection] = queue.SimpleQueue()
+        self._all: list[sqlite3.Connection] = []
+        for _ in range(max(size, 1)):
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=_SQL_CACHED_STATEMENTS)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute(f"PRAGMA cache_size=-{_SQL_CACHE_SIZE_KIB}")
+            conn.execute(f"PRAGMA mmap_size={_SQL_MMAP_SIZE}")
+            conn.execute("PRAGMA query_only=1")
+            self._conns.put(conn)
+            self._all.append(conn)
+
+    @contextmanager
+    def acquire(self) -> Iterator[sqlite3.Connection]:
+        conn = self._conns.get()
+        try:
+            yield conn
+        finally:
+            self._conns.put(conn)
+
+    def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        with self.acquire() as conn:
+            return fn(conn, *args)
+
+    def close(self) -> None:
+        for conn in self._all:
+            conn.close()
+
+
+@contextmanager
+def write_tx(conn: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+    """Пишущая транзакция BEGIN IMMEDIATE ... COMMIT; вложенный вызов входит во внешнюю."""
+    with _TX_LOCK:
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+# Один поток на общее соединение: вызовы sqlite3 уходят с event loop, но остаются последовательными
+_DB_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+
+async def _db(fn: Callable[..., Any], *args: Any) -> Any:
+    """Выполняет синхронную DB-функцию в потоке _DB_EXECUTOR, не блокируя обработку апдейтов."""
+    return await asyncio.get_running_loop().run_in_executor(_DB_EXECUTOR, fn, *args)
+
+
+# Создаётся в main() после init_db; до этого чтения идут через общее соединение.
+# Через пул — только чтения без in-memory кэша: _get_group_row/_get_user_row остаются на _db,
+# иначе устаревшее чтение из другого потока может лечь в кэш после его сброса.
+_READ_POOL: Optional[ReadPool] = None
+
+
+async def _db_read(conn: sqlite3.Connection, fn: Callable[..., Any], *args: Any) -> Any:
+    """Только для чтения: fn(ro_conn, *args) на соединении из _READ_POOL в потоке по умолчанию."""
+    if _READ_POOL is None:
+        return await _db(fn, conn, *args)
+    return await asyncio.to_thread(_READ_POOL.run, fn, *args)
+
+
+# Отложенные мелкие записи: первая запись будит flusher, он ждёт WRITE_FLUSH_INTERVAL,
+# чтобы собрать соседние, и коммитит всё одной транзакцией. В простое flusher спит.
+WRITE_FLUSH_INTERVAL = 0.01
+_PENDING_WRITES: list[Tuple[Callable[..., Any], Tuple[Any, ...]]] = []
+_WRITES_READY = asyncio.Event()
+_WRITE_FLUSHER: Optional[asyncio.Task] = None
+
+
+def defer_write(fn: Callable[..., Any], *args: Any) -> None:
+    """Ставит fn(conn, *args) в очередь; вызывать только из event loop."""
+    _PENDING_WRITES.append((fn, args))
+    _WRITES_READY.set()
+
+
+def _apply_writes(conn: sqlite3.Connection, batch: list[Tuple[Callable[..., Any], Tuple[Any, ...]]]) -> None:
+    # write_tx внутри fn входит во внешнюю транзакцию — весь пакет коммитится один раз
+    with write_tx(conn):
+        for fn, args in batch:
+            fn(conn, *args)
+
+
+async def _flush_writes(conn: sqlite3.Connection) -> None:
+    if not _PENDING_WRITES:
+        return
+    batch = _PENDING_WRITES.copy()
+    _PENDING_WRITES.clear()
+    try:
+        await _db(_apply_writes, conn, batch)
+    except Exception as e:
+        logger.error("Ошибка пакетной записи в БД (%s операций): %s", len(batch), e)
+
+
+async def _write_flusher(conn: sqlite3.Connection) -> None:
+    while True:
+        await _WRITES_READY.wait()
+        await asyncio.sleep(WRITE_FLUSH_INTERVAL)
+        _WRITES_READY.clear()
+        await _flush_writes(conn)
+
+
+# Общая схема для tickets (открытые) и tickets_archive (финальные статусы)
+_TICKETS_COLUMNS = """(
                 ticket_id TEXT PRIMARY KEY,
                 task_number TEXT,
                 chat_id INTEGER,
@@ -232,58 +442,141 @@ def init_db(conn: sqlite3.Connection) -> None:
                 last_notified_reminder TEXT,
                 status_changed_at TEXT
             )"""
-        )
-        c.execute(
-            """CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER,
-                chat_id INTEGER,
-                intradesk_user_id TEXT,
-                legal_entity_id TEXT,
-                external_id TEXT,
-                PRIMARY KEY (user_id, chat_id)
-            )"""
-        )
-        c.execute(
-            """CREATE TABLE IF NOT EXISTS groups (
-                chat_id INTEGER PRIMARY KEY,
-                legal_entity_id TEXT,
-                external_id TEXT,
-                welcomed INTEGER DEFAULT 0
-            )"""
-        )
-        c.execute(
-            """CREATE TABLE IF NOT EXISTS user_comments (
-                ticket_id TEXT,
-                comment_text TEXT,
-                PRIMARY KEY (ticket_id, comment_text)
-            )"""
-        )
-        conn.commit()
-    logger.info("База данных инициализирована")
+
+
+# Версия схемы: поднимать при любом изменении DDL ниже
+_SCHEMA_VERSION = 2
+
+
+def _schema_script(finals: str) -> str:
+    """
+    Весь DDL одной строкой для executescript.
+    Горячая/холодная часть tickets: заявки в финальном статусе триггерами переезжают
+    в tickets_archive (и обратно при переоткрытии). Полная история — во VIEW tickets_all.
+    Триггеры зависят от final_statuses в config.ini, поэтому finals входит в версию схемы.
+    """
+    move_to_archive = """
+            BEGIN
+                INSERT OR REPLACE INTO tickets_archive SELECT * FROM tickets WHERE ticket_id = NEW.ticket_id;
+                DELETE FROM tickets WHERE ticket_id = NEW.ticket_id;
+            END"""
+    return f"""
+        CREATE TABLE IF NOT EXISTS tickets {_TICKETS_COLUMNS};
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER,
+            chat_id INTEGER,
+            intradesk_user_id TEXT,
+            legal_entity_id TEXT,
+            external_id TEXT,
+            PRIMARY KEY (user_id, chat_id)
+        );
+        CREATE TABLE IF NOT EXISTS groups (
+            chat_id INTEGER PRIMARY KEY,
+            legal_entity_id TEXT,
+            external_id TEXT,
+            welcomed INTEGER DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS user_comments (
+            ticket_id TEXT,
+            comment_text TEXT,
+            PRIMARY KEY (ticket_id, comment_text)
+        );
+        CREATE TABLE IF NOT EXISTS kv (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS tickets_archive {_TICKETS_COLUMNS};
+        CREATE VIEW IF NOT EXISTS tickets_all AS SELECT * FROM tickets UNION ALL SELECT * FROM tickets_archive;
+
+        -- has_open_ticket / list_tickets: покрывающий индекс, оба запроса отвечаются без чтения
+        -- строк таблицы (ticket_id в нём явно: вторичный индекс rowid-таблицы хранит только rowid)
+        DROP INDEX IF EXISTS idx_tickets_user_chat_status;
+        CREATE INDEX IF NOT EXISTS idx_tickets_user_chat_open ON tickets (user_id, chat_id, status, task_number, ticket_id);
+
+        DROP TRIGGER IF EXISTS tickets_archive_on_insert;
+        DROP TRIGGER IF EXISTS tickets_archive_on_update;
+        DROP TRIGGER IF EXISTS tickets_active_on_insert;
+        DROP TRIGGER IF EXISTS tickets_restore_on_update;
+        CREATE TRIGGER tickets_archive_on_insert AFTER INSERT ON tickets
+            WHEN NEW.status IN ({finals}) {move_to_archive};
+        CREATE TRIGGER tickets_archive_on_update AFTER UPDATE OF status ON tickets
+            WHEN NEW.status IN ({finals}) {move_to_archive};
+        CREATE TRIGGER tickets_active_on_insert AFTER INSERT ON tickets
+            WHEN NEW.status IS NULL OR NEW.status NOT IN ({finals})
+            BEGIN
+                DELETE FROM tickets_archive WHERE ticket_id = NEW.ticket_id;
+            END;
+        CREATE TRIGGER tickets_restore_on_update AFTER UPDATE OF status ON tickets_archive
+            WHEN NEW.status IS NULL OR NEW.status NOT IN ({finals})
+            BEGIN
+                INSERT OR REPLACE INTO tickets SELECT * FROM tickets_archive WHERE ticket_id = NEW.ticket_id;
+                DELETE FROM tickets_archive WHERE ticket_id = NEW.ticket_id;
+            END;
+
+        -- разовый перенос уже закрытых заявок (старые БД / изменившийся final_statuses)
+        INSERT OR REPLACE INTO tickets_archive SELECT * FROM tickets WHERE status IN ({finals});
+        DELETE FROM tickets WHERE status IN ({finals});
+    """
+
+
+def init_db(conn: sqlite3.Connection) -> None:
+    finals = ",".join(str(s) for s in FINAL_STATUSES_TUPLE)
+    version = f"{_SCHEMA_VERSION}:{finals}"
+    try:
+        row = conn.execute("SELECT value FROM kv WHERE key = 'init_db_version'").fetchone()
+    except sqlite3.OperationalError:
+        row = None  # новая БД: таблицы kv ещё нет
+    if row and row[0] == version:
+        logger.info("База данных актуальна (схема %s)", version)
+        return
+
+    # executescript сам коммитит открытую транзакцию, поэтому BEGIN/COMMIT — внутри скрипта
+    with _TX_LOCK:
+        try:
+            conn.executescript(
+                "BEGIN IMMEDIATE;"
+                + _schema_script(finals)
+                + f"INSERT OR REPLACE INTO kv (key, value) VALUES ('init_db_version', '{version}');"
+                + "COMMIT;"
+            )
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+    logger.info("База данных инициализирована (схема %s)", version)
+
+
+# groups пишется только через mark_group_welcomed, поэтому найденные строки можно держать в памяти
+# процесса и сбрасывать запись при регистрации группы; отсутствие строки не кэшируется, чтобы
+# запоздавшее заполнение не пережило регистрацию. Значение: (legal_entity_id, external_id, welcomed).
+# Кэш без блокировок: заполнять и сбрасывать его можно только на _DB_EXECUTOR (через _db).
+_GROUP_CACHE: Dict[int, Tuple[Optional[str], Optional[str], int]] = {}
+
+
+def _get_group_row(conn: sqlite3.Connection, chat_id: int) -> Tuple[Optional[str], Optional[str], int]:
+    cached = _GROUP_CACHE.get(chat_id)
+    if cached is not None:
+        return cached
+    c = conn.cursor()
+    c.execute("SELECT legal_entity_id, external_id, welcomed FROM groups WHERE chat_id = ?", (chat_id,))
+    row = c.fetchone()
+    if not row:
+        return (None, None, 0)
+    cached = (row[0], row[1], row[2] or 0)
+    _GROUP_CACHE[chat_id] = cached
+    return cached
 
 
 def is_group_welcomed(conn: sqlite3.Connection, chat_id: int) -> int:
-    with conn:
-        c = conn.cursor()
-        c.execute("SELECT welcomed FROM groups WHERE chat_id = ?", (chat_id,))
-        row = c.fetchone()
-    return (row[0] if row else 0) if row is not None else 0
+    return _get_group_row(conn, chat_id)[2]
 
 
 def get_legal_entity_id(conn: sqlite3.Connection, chat_id: int) -> Optional[str]:
-    with conn:
-        c = conn.cursor()
-        c.execute("SELECT legal_entity_id FROM groups WHERE chat_id = ?", (chat_id,))
-        row = c.fetchone()
-    return row[0] if row else None
+    return _get_group_row(conn, chat_id)[0]
 
 
 def get_group_external_id(conn: sqlite3.Connection, chat_id: int) -> Optional[str]:
-    with conn:
-        c = conn.cursor()
-        c.execute("SELECT external_id FROM groups WHERE chat_id = ?", (chat_id,))
-        row = c.fetchone()
-    return row[0] if row else None
+    return _get_group_row(conn, chat_id)[1]
 
 
 def mark_group_welcomed(
@@ -292,16 +585,56 @@ def mark_group_welcomed(
     legal_entity_id: Optional[str] = None,
     external_id: Optional[str] = None,
 ) -> None:
-    with conn:
+    with write_tx(conn):
         c = conn.cursor()
         c.execute(
             "INSERT OR REPLACE INTO groups (chat_id, legal_entity_id, external_id, welcomed) VALUES (?, ?, ?, 1)",
             (chat_id, legal_entity_id, external_id),
         )
-        conn.commit()
+    _GROUP_CACHE.pop(chat_id, None)
     logger.info(f"Группа {chat_id} отмечена как приветствованная")
 
 
+# users пишется только через save_user; кэшируем найденные строки
+# (intradesk_user_id, legal_entity_id, external_id), отсутствие строки не кэшируется.
+# Как и _GROUP_CACHE, кэш заполняется и сбрасывается только на _DB_EXECUTOR (через _db).
+_USER_CACHE: Dict[Tuple[int, int], Tuple[str, Optional[str], Optional[str]]] = {}
+
+
+def _get_user_row(conn: sqlite3.Connection, user_id: int, chat_id: int) -> Optional[Tuple[str, Optional[str], Optional[str]]]:
+    key = (user_id, chat_id)
+    cached = _USER_CACHE.get(key)
+    if cached is not None:
+        return cached
+    c = conn.cursor()
+    c.execute("SELECT intradesk_user_id, legal_entity_id, external_id FROM users WHERE user_id = ? AND chat_id = ?", key)
+    row = c.fetchone()
+    if not row:
+        return None
+    cached = (row[0], row[1], row[2])
+    _USER_CACHE[key] = cached
+    return cached
+
+
+def save_user(
+    conn: sqlite3.Connection,
+    user_id: int,
+    chat_id: int,
+    intradesk_user_id: str,
+    legal_entity_id: str,
+    external_id: str,
+    replace: bool = False,
+) -> None:
+    verb = "INSERT OR REPLACE" if replace else "INSERT"
+    with write_tx(conn):
+        c = conn.cursor()
+        c.execute(
+            f"{verb} INTO users (user_id, chat_id, intradesk_user_id, legal_entity_id, external_id) VALUES (?, ?, ?, ?, ?)",
+            (user_id, chat_id, intradesk_user_id, legal_entity_id, external_id),
+        )
+    _USER_CACHE.pop((user_id, chat_id), None)
+
+
 def save_ticket(
     conn: sqlite3.Connection,
     ticket_id: str,
@@ -318,7 +651,7 @@ def save_ticket(
     last_notified_reminder: Optional[str] = None,
     status_changed_at: Optional[str] = None,
 ) -> None:
-    with conn:
+    with write_tx(conn):
         c = conn.cursor()
         c.execute(
             """
@@ -344,109 +677,207 @@ def save_ticket(
                 status_changed_at,
             ),
         )
-        conn.commit()
     logger.info(f"Сохранена заявка: ticket_id={ticket_id}, task_number={task_number}")
 
 
 def save_user_comment(conn: sqlite3.Connection, ticket_id: str, comment_text: str) -> None:
-    with conn:
+    with write_tx(conn):
         c = conn.cursor()
         c.execute(
             "INSERT OR IGNORE INTO user_comments (ticket_id, comment_text) VALUES (?, ?)",
             (ticket_id, comment_text),
         )
-        conn.commit()
 
 
 def clear_user_comments(conn: sqlite3.Connection, ticket_id: str) -> None:
-    with conn:
+    with write_tx(conn):
         c = conn.cursor()
         c.execute("DELETE FROM user_comments WHERE ticket_id = ?", (ticket_id,))
-        conn.commit()
 
 
 def is_user_comment(conn: sqlite3.Connection, ticket_id: str, comment_text: str) -> bool:
-    with conn:
-        c = conn.cursor()
-        c.execute(
-            "SELECT 1 FROM user_comments WHERE ticket_id = ? AND comment_text = ?",
-            (ticket_id, comment_text),
-        )
-        row = c.fetchone()
+    c = conn.cursor()
+    c.execute(
+        "SELECT 1 FROM user_comments WHERE ticket_id = ? AND comment_text = ?",
+        (ticket_id, comment_text),
+    )
+    row = c.fetchone()
     return bool(row)
 
 
 def get_ticket_info(conn: sqlite3.Connection, ticket_id: str) -> Tuple:
-    with conn:
-        c = conn.cursor()
-        c.execute(
-            """
-            SELECT chat_id, user_id, message_id, last_user_message_id, last_updated,
-                   status, last_comment, notified_status, last_engineer_comment,
-                   last_notified_reminder, task_number
-            FROM tickets WHERE ticket_id = ?
-            """,
-            (ticket_id,),
-        )
-        row = c.fetchone()
+    c = conn.cursor()
+    c.execute(
+        """
+        SELECT chat_id, user_id, message_id, last_user_message_id, last_updated,
+               status, last_comment, notified_status, last_engineer_comment,
+               last_notified_reminder, task_number
+        FROM tickets_all WHERE ticket_id = ?
+        """,
+        (ticket_id,),
+    )
+    row = c.fetchone()
     return tuple(row) if row else (None, None, None, None, None, None, None, None, None, None, None)
 
 
-def has_open_ticket(conn: sqlite3.Connection, user_id: int, chat_id: int) -> Optional[str]:
-    with conn:
+def clear_ticket_message_id(conn: sqlite3.Connection, ticket_id: str) -> None:
+    """Обнуляет message_id и для открытой, и для уже архивной заявки."""
+    with write_tx(conn):
         c = conn.cursor()
-        c.execute(
-            "SELECT ticket_id, status FROM tickets WHERE user_id = ? AND chat_id = ?",
-            (user_id, chat_id),
-        )
-        rows = c.fetchall()
-    for t in rows or []:
-        ticket_id, status = t[0], t[1]
-        if status not in FINAL_STATUSES:
-            logger.info(f"Найдена открытая заявка: ticket_id={ticket_id}")
-            return ticket_id
+        c.execute("UPDATE tickets SET message_id = 0 WHERE ticket_id = ?", (ticket_id,))
+        c.execute("UPDATE tickets_archive SET message_id = 0 WHERE ticket_id = ?", (ticket_id,))
+
+
+# фильтр по финальным статусам — в SQL, чтобы не тянуть все заявки пользователя в Python
+_SQL_HAS_OPEN_TICKET = (
+    "SELECT ticket_id FROM tickets WHERE user_id = ? AND chat_id = ? "
+    f"AND (status IS NULL OR status NOT IN ({FINAL_STATUSES_SQL_PLACEHOLDERS})) LIMIT 1"
+)
+
+
+def has_open_ticket(conn: sqlite3.Connection, user_id: int, chat_id: int) -> Optional[str]:
+    c = conn.cursor()
+    c.execute(_SQL_HAS_OPEN_TICKET, (user_id, chat_id) + FINAL_STATUSES_TUPLE)
+    row = c.fetchone()
+    if row:
+        ticket_id = row[0]
+        logger.info(f"Найдена открытая заявка: ticket_id={ticket_id}")
+        return ticket_id
     return None
 
+
+def get_ticket_ref(conn: sqlite3.Connection, ticket_id: str) -> Optional[Tuple[Optional[str], Optional[int]]]:
+    """(task_number, message_id) заявки или None, если её нет в БД."""
+    c = conn.cursor()
+    c.execute("SELECT task_number, message_id FROM tickets_all WHERE ticket_id = ?", (ticket_id,))
+    row = c.fetchone()
+    return (row[0], row[1]) if row else None
+
+
+def get_ticket_status(conn: sqlite3.Connection, ticket_id: str) -> Optional[int]:
+    c = conn.cursor()
+    c.execute("SELECT status FROM tickets_all WHERE ticket_id = ?", (ticket_id,))
+    row = c.fetchone()
+    return int(row[0]) if row and row[0] is not None else None
+
+
+def set_tickets_message_id(conn: sqlite3.Connection, message_id: int, ticket_ids: list[str]) -> None:
+    with write_tx(conn):
+        conn.executemany(
+            "UPDATE tickets SET message_id = ? WHERE ticket_id = ?",
+            [(message_id, ticket_id) for ticket_id in ticket_ids],
+        )
+
+
+# Закрытые заявки триггеры уже унесли в tickets_archive, так что tickets сама по себе — «частичный
+# индекс» открытых; NOT IN по тем же FINAL_STATUSES, что и в триггерах, — страховка, а не фильтр
+_SQL_OPEN_TICKETS = (
+    "SELECT ticket_id, task_number, status FROM tickets "
+    f"WHERE user_id = ? AND chat_id = ? AND status NOT IN ({FINAL_STATUSES_SQL_PLACEHOLDERS})"
+)
+
+
+def get_open_tickets(conn: sqlite3.Connection, user_id: int, chat_id: int) -> list[sqlite3.Row]:
+    c = conn.cursor()
+    c.execute(_SQL_OPEN_TICKETS, (user_id, chat_id) + FINAL_STATUSES_TUPLE)
+    return c.fetchall()
+
+
+def get_active_tickets(conn: sqlite3.Connection) -> list[sqlite3.Row]:
+    """Все заявки горячей таблицы (закрытые уже переехали в tickets_archive)."""
+    c = conn.cursor()
+    c.execute(
+        """
+        SELECT ticket_id, task_number, chat_id, user_id, message_id, last_user_message_id, last_comment,
+               last_updated, status, notified_status, last_engineer_comment, last_notified_reminder, status_changed_at
+        FROM tickets
+        """
+    )
+    return c.fetchall()
+
 # ==========================
 # IntraDesk helpers
 # ==========================
 
-ID_HEADERS_JSON = {
+# Адреса с ApiKey собираются один раз; в функциях к ним добавляется только $filter
+_ID_LEGAL_ENTITIES_ENDPOINT = f"{INTRADESK_LEGAL_ENTITIES_URL}?ApiKey={INTRADESK_API_KEY}"
+_ID_LEGAL_USERS_ENDPOINT = f"{INTRADESK_LEGAL_USERS_URL}?ApiKey={INTRADESK_API_KEY}"
+_ID_TASKS_WRITE_ENDPOINT = f"{TASKS_WRITE_URL}?ApiKey={INTRADESK_API_KEY}"
+_ID_TASKS_ODATA_ENDPOINT = f"{TASKS_ODATA_URL}?ApiKey={INTRADESK_API_KEY}"
+_ID_CLIENTS_ODATA_URL = f"{INTRADESK_URL}/settings/odata/v2/Clients"
+
+# Одна сессия на все запросы к IntraDesk: keep-alive вместо нового TCP+TLS на каждый вызов.
+# Пул urllib3 потокобезопасен: сами HTTP-вызовы уходят в asyncio.to_thread, чтобы сетевой round-trip
+# не блокировал event loop, а чтения и записи SQLite вокруг них идут через _db. Размер пула не меньше POLL_CONCURRENCY,
+# иначе параллельный опрос статусов выбрасывает лишние соединения ("Connection pool is full").
+# Авторизация — в заголовках сессии; Content-Type для json= requests выставляет сам.
+_ID_SESSION = requests.Session()
+_ID_SESSION.headers.update({
     "Authorization": f"Bearer {INTRADESK_AUTH_TOKEN}",
     "Accept": "application/json",
-}
-ID_HEADERS_JSON_W = {
-    "Authorization": f"Bearer {INTRADESK_AUTH_TOKEN}",
-    "Content-Type": "application/json",
-}
+})
+_ID_ADAPTER = HTTPAdapter(pool_connections=4, pool_maxsize=max(POLL_CONCURRENCY, 10))
+_ID_SESSION.mount("https://", _ID_ADAPTER)
+_ID_SESSION.mount("http://", _ID_ADAPTER)
+
+
+def _id_block(value: Any) -> str:
+    """Значение блока IntraDesk — JSON-строка {"value": ...}; json.dumps экранирует кавычки и переводы строк в тексте."""
+    return json.dumps({"value": value}, ensure_ascii=False, separators=(",", ":"))
+
+
+def _is_transient(e: BaseException) -> bool:
+    """Повторять имеет смысл только сетевые сбои и 5xx; 4xx при повторе не исправится."""
+    if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return True
+    return isinstance(e, requests.HTTPError) and e.response is not None and e.response.status_code >= 500
+
+
+# экспоненциальная пауза с джиттером: повторы разных запросов не бьют в IntraDesk одновременно
+_ID_RETRY = retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=0.5, max=5) + wait_random(0, 0.5),
+    retry=retry_if_exception(_is_transient),
+)
+
 
+# Недавние «не найдено» по external_id: повторный онбординг того же чата в течение TTL
+# не ходит в IntraDesk заново. Запись снимается, когда группа зарегистрирована.
+_GROUP_MISS_TTL = 60.0
+_GROUP_MISS_CACHE: Dict[str, float] = {}
 
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
+
+@_ID_RETRY
 def check_group_in_intradesk(external_id: str) -> Optional[str]:
-    url = f"{INTRADESK_LEGAL_ENTITIES_URL}?ApiKey={INTRADESK_API_KEY}&$filter=externalId eq '{external_id}'"
+    missed_at = _GROUP_MISS_CACHE.get(external_id)
+    if missed_at is not None and time.monotonic() - missed_at < _GROUP_MISS_TTL:
+        return None
+    url = f"{_ID_LEGAL_ENTITIES_ENDPOINT}&$filter=externalId eq '{external_id}'"
     try:
-        r = requests.get(url, headers=ID_HEADERS_JSON, timeout=20)
+        r = _ID_SESSION.get(url, timeout=20)
         r.raise_for_status()
         data = r.json()
         if data.get("value"):
+            _GROUP_MISS_CACHE.pop(external_id, None)
             return str(data["value"][0]["id"])  # API sometimes returns int
+        _GROUP_MISS_CACHE[external_id] = time.monotonic()
         return None
     except requests.RequestException as e:
         logger.error(
             "Ошибка проверки группы в IntraDesk for external_id=%s: %s; resp=%s; URL=%s",
             external_id,
             e,
-            getattr(e, "response", None).text if getattr(e, "response", None) else "<no response>",
+            _resp_text(e),
             url,
         )
         raise
 
 
 def check_legal_entity_by_inn(inn: str) -> Optional[str]:
-    url = f"{INTRADESK_URL}/settings/odata/v2/Clients"
+    url = _ID_CLIENTS_ODATA_URL
     params = {"ApiKey": INTRADESK_API_KEY, "$filter": f"(taxpayerNumber eq '{inn}' and isArchived eq false)"}
     try:
-        r = requests.get(url, headers=ID_HEADERS_JSON, params=params, timeout=20)
+        r = _ID_SESSION.get(url, params=params, timeout=20)
         r.raise_for_status()
         data = r.json()
         clients = data.get("value", [])
@@ -455,14 +886,14 @@ def check_legal_entity_by_inn(inn: str) -> Optional[str]:
         logger.error("Компания с ИНН %s не найдена среди активных. resp=%s", inn, r.text)
         return None
     except requests.RequestException as e:
-        logger.error("Ошибка запроса к IntraDesk для ИНН %s: %s; resp=%s", inn, e, getattr(e, "response", None).text if getattr(e, "response", None) else "<no response>")
+        logger.error("Ошибка запроса к IntraDesk для ИНН %s: %s; resp=%s", inn, e, _resp_text(e))
         return None
 
 
 async def register_legal_entity(chat_id: int, chat_title: str, chat_description: Optional[str], inn: Optional[str] = None) -> Optional[str]:
     external_id = f"telegram_personal_{chat_id}" if chat_id > 0 else f"telegram_group_{chat_id}"
     try:
-        existing_id = check_group_in_intradesk(external_id)
+        existing_id = await asyncio.to_thread(check_group_in_intradesk, external_id)
         if existing_id:
             return existing_id
     except Exception as e:  # already logged
@@ -476,14 +907,15 @@ async def register_legal_entity(chat_id: int, chat_title: str, chat_description:
     if inn:
         data["taxpayerNumber"] = inn
 
-    url = f"{INTRADESK_LEGAL_ENTITIES_URL}?ApiKey={INTRADESK_API_KEY}"
+    url = _ID_LEGAL_ENTITIES_ENDPOINT
     try:
-        r = requests.post(url, json=data, headers=ID_HEADERS_JSON_W, timeout=30)
+        r = await asyncio.to_thread(_ID_SESSION.post, url, json=data, timeout=30)
         r.raise_for_status()
+        _GROUP_MISS_CACHE.pop(external_id, None)
         j = r.json()
         return str(j if isinstance(j, (int, str)) else j.get("id"))
     except requests.RequestException as e:
-        logger.error("Ошибка регистрации юр. лица для чата %s: %s; resp=%s; URL=%s", chat_id, e, getattr(e, "response", None).text if getattr(e, "response", None) else "<no response>", url)
+        logger.error("Ошибка регистрации юр. лица для чата %s: %s; resp=%s; URL=%s", chat_id, e, _resp_text(e), url)
         return None
 
 
@@ -492,7 +924,7 @@ def check_user_in_intradesk(external_id: str) -> Optional[str]:
     return None
 
 
-def register_legal_entity_user(
+async def register_legal_entity_user(
     conn: sqlite3.Connection,
     user_id: int,
     chat_id: int,
@@ -500,25 +932,16 @@ def register_legal_entity_user(
     username: Optional[str],
     legal_entity_id: str,
 ) -> Optional[str]:
-    with conn:
-        c = conn.cursor()
-        c.execute("SELECT intradesk_user_id FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
-        row = c.fetchone()
-        if row:
-            intradesk_id = row[0]
-            logger.info("Пользователь %s уже зарегистрирован в SQLite: %s", user_id, intradesk_id)
-            return intradesk_id
+    row = await _db(_get_user_row, conn, user_id, chat_id)
+    if row:
+        intradesk_id = row[0]
+        logger.info("Пользователь %s уже зарегистрирован в SQLite: %s", user_id, intradesk_id)
+        return intradesk_id
 
     external_id = f"telegram_user_{user_id}_group_{chat_id}" if chat_id < 0 else f"telegram_user_{user_id}_personal_{chat_id}"
     existing_id = check_user_in_intradesk(external_id)
     if existing_id:
-        with conn:
-            c = conn.cursor()
-            c.execute(
-                "INSERT OR REPLACE INTO users (user_id, chat_id, intradesk_user_id, legal_entity_id, external_id) VALUES (?, ?, ?, ?, ?)",
-                (user_id, chat_id, str(existing_id), legal_entity_id, external_id),
-            )
-            conn.commit()
+        await _db(save_user, conn, user_id, chat_id, str(existing_id), legal_entity_id, external_id, True)
         return str(existing_id)
 
     data: Dict[str, Any] = {
@@ -529,155 +952,179 @@ def register_legal_entity_user(
     if username:
         data["telegramUsername"] = username
 
-    url = f"{INTRADESK_LEGAL_USERS_URL}?ApiKey={INTRADESK_API_KEY}"
+    url = _ID_LEGAL_USERS_ENDPOINT
     try:
-        r = requests.post(url, json=data, headers=ID_HEADERS_JSON_W, timeout=30)
+        r = await asyncio.to_thread(_ID_SESSION.post, url, json=data, timeout=30)
         r.raise_for_status()
         j = r.json()
-        intradesk_user_id = str(j if isinstance(j, (int, str)) else j.get("id"))
-        with conn:
-            c = conn.cursor()
-            c.execute(
-                "INSERT INTO users (user_id, chat_id, intradesk_user_id, legal_entity_id, external_id) VALUES (?, ?, ?, ?, ?)",
-                (user_id, chat_id, intradesk_user_id, legal_entity_id, external_id),
-            )
-            conn.commit()
+        raw_id = j if isinstance(j, (int, str)) else j.get("id")
+        if raw_id is None:
+            logger.error("IntraDesk не вернул id пользователя %s: resp=%s", user_id, r.text)
+            return None
+        intradesk_user_id = str(raw_id)
+        await _db(save_user, conn, user_id, chat_id, intradesk_user_id, legal_entity_id, external_id)
         logger.info("Пользователь зарегистрирован: %s", intradesk_user_id)
         return intradesk_user_id
     except requests.HTTPError as e:
-        resp = getattr(e, "response", None)
+        resp = e.response
         if resp is not None and resp.status_code == 409:
             logger.warning("Пользователь с externalId %s уже существует. resp=%s", external_id, resp.text)
             existing_id = check_user_in_intradesk(external_id)
             if existing_id:
-                with conn:
-                    c = conn.cursor()
-                    c.execute(
-                        "INSERT OR REPLACE INTO users (user_id, chat_id, intradesk_user_id, legal_entity_id, external_id) VALUES (?, ?, ?, ?, ?)",
-                        (user_id, chat_id, str(existing_id), legal_entity_id, external_id),
-                    )
-                    conn.commit()
+                await _db(save_user, conn, user_id, chat_id, str(existing_id), legal_entity_id, external_id, True)
                 return str(existing_id)
         logger.error("Ошибка регистрации пользователя: %s; resp=%s", e, resp.text if resp is not None else "<no response>")
         return None
     except requests.RequestException as e:
-        logger.error("Ошибка регистрации пользователя: %s; resp=%s", e, getattr(e, "response", None).text if getattr(e, "response", None) else "<no response>")
+        logger.error("Ошибка регистрации пользователя: %s; resp=%s", e, _resp_text(e))
         return None
 
 
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
-def create_ticket(
+def _save_new_ticket(
+    conn: sqlite3.Connection,
+    ticket_id: str,
+    task_number: str,
+    chat_id: int,
+    user_id: int,
+    message_id: int,
+    last_user_message_id: int,
+    description: str,
+    last_updated: str,
+    status: int,
+) -> None:
+    # обе записи — одной транзакцией (вложенные write_tx входят во внешнюю): один COMMIT вместо двух
+    with write_tx(conn):
+        save_user_comment(conn, ticket_id, description)
+        save_ticket(conn, ticket_id, task_number, chat_id, user_id, message_id, last_user_message_id, last_updated, status)
+
+
+async def create_ticket(
     conn: sqlite3.Connection,
     title: str,
     description: str,
     user_id: int,
     chat_id: int,
     chat_title: Optional[str] = None,
-    file_path: Optional[str] = None,
-) -> Tuple[Optional[str], Optional[str], Optional[int], str]:
-    legal_entity_id = get_legal_entity_id(conn, chat_id)
+    attachment: Optional[Tuple[str, bytes | bytearray]] = None,
+) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[int], str]:
+    """(ticket_id, task_number, last_updated, status, текст результата); в БД заявку сохраняет вызывающий (_save_new_ticket)."""
+    legal_entity_id = await _db(get_legal_entity_id, conn, chat_id)
     if not legal_entity_id:
-        return None, None, None, "Ошибка: чат не зарегистрирован как юр. лицо"
+        return None, None, None, None, "Ошибка: чат не зарегистрирован как юр. лицо"
 
-    with conn:
-        c = conn.cursor()
-        c.execute("SELECT intradesk_user_id, external_id FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
-        row = c.fetchone()
+    row = await _db(_get_user_row, conn, user_id, chat_id)
     if not row:
-        return None, None, None, "Ошибка: пользователь не зарегистрирован"
-    intradesk_user_id, external_id = row[0], row[1]
+        return None, None, None, None, "Ошибка: пользователь не зарегистрирован"
+    intradesk_user_id, external_id = row[0], row[2]
+    # IntraDesk ждёт числовые id инициатора; битую строку users (например, "None") не шлём, а сообщаем об ошибке
+    try:
+        initiator = {"groupid": int(legal_entity_id), "userid": int(intradesk_user_id)}
+    except (TypeError, ValueError):
+        logger.error("Некорректные id инициатора: legal_entity_id=%r intradesk_user_id=%r (user=%s chat=%s)",
+                     legal_entity_id, intradesk_user_id, user_id, chat_id)
+        return None, None, None, None, "Ошибка: некорректная регистрация пользователя, обратитесь к администратору"
 
     ticket_title = f"Заявка из Telegram {chat_title}" if chat_id < 0 and chat_title else f"Заявка из Telegram {user_id}"
 
     data: Dict[str, Any] = {
         "blocks": {
-            "name": f"{{\"value\":\"{ticket_title}\"}}",
-            "description": f"{{\"value\":\"{description} (от пользователя {external_id})\"}}",
-            "priority": "{\"value\":3}",
-            "initiator": f"{{\"value\":{{\"groupid\":{legal_entity_id},\"userid\":{intradesk_user_id}}}}}",
+            "name": _id_block(ticket_title),
+            "description": _id_block(f"{description} (от пользователя {external_id})"),
+            "priority": _id_block(3),
+            "initiator": _id_block(initiator),
         },
         "Channel": "telegram",
         "clientId": legal_entity_id,
     }
 
-    if file_path:
-        fid, fname = upload_file_to_intradesk(file_path, INTRADESK_API_KEY, "Description")
+    if attachment:
+        fid, fname = await asyncio.to_thread(upload_file_to_intradesk, attachment, INTRADESK_API_KEY, "Description")
         if fid:
-            size = os.path.getsize(file_path)
+            size = len(attachment[1])
             ext = os.path.splitext(fname)[1][1:]
-            data["blocks"]["attachments"] = (
-                f"{{\"value\":{{\"addFiles\":[{{\"name\":\"{fname}\",\"id\":\"{fid}\",\"contentType\":\"{ext}\",\"size\":{size},\"target\":20}}],\"deleteFileIds\":[]}}}}"
-            )
+            data["blocks"]["attachments"] = _id_block({
+                "addFiles": [{"name": fname, "id": str(fid), "contentType": ext, "size": size, "target": 20}],
+                "deleteFileIds": [],
+            })
 
-    url = f"{TASKS_WRITE_URL}?ApiKey={INTRADESK_API_KEY}"
+    url = _ID_TASKS_WRITE_ENDPOINT
     try:
-        r = requests.post(url, json=data, headers=ID_HEADERS_JSON_W, timeout=30)
+        r = await asyncio.to_thread(_ID_SESSION.post, url, json=data, timeout=30)
         r.raise_for_status()
         j = r.json()
         ticket_id = j.get("Id")
         task_number = str(j.get("Number")) if j.get("Number") is not None else None
         if not ticket_id or not task_number:
             logger.error("Не удалось извлечь ticket_id/Number: resp=%s", r.text)
-            return None, None, None, "Ошибка: не удалось создать заявку"
-        last_updated = j.get("UpdatedAt", dt.datetime.now(pytz.UTC).isoformat())
+            return None, None, None, None, "Ошибка: не удалось создать заявку"
+        last_updated = j.get("UpdatedAt", dt.datetime.now(dt.timezone.utc).isoformat())
         status = int(j.get("Fields", {}).get("status", OPEN_STATUS_ID))
-        save_user_comment(conn, ticket_id, description)
-        save_ticket(conn, ticket_id, task_number, chat_id, user_id, 0, 0, last_updated, status)
-        return ticket_id, last_updated, status, f"Заявка #{task_number} успешно создана!"
+        return ticket_id, task_number, last_updated, status, f"Заявка #{task_number} успешно создана!"
     except requests.RequestException as e:
-        logger.error("Ошибка создания заявки: %s; resp=%s", e, getattr(e, "response", None).text if getattr(e, "response", None) else "<no response>")
-        return None, None, None, f"Ошибка: {e}"
+        logger.error("Ошибка создания заявки: %s; resp=%s", e, _resp_text(e))
+        return None, None, None, None, f"Ошибка: {e}"
 
 
-def upload_file_to_intradesk(file_path: str, api_key: str, target: str = "Description", ticket_id: str = "0") -> Tuple[Optional[str], Optional[str]]:
+def upload_file_to_intradesk(attachment: Tuple[str, bytes | bytearray], api_key: str, target: str = "Description", ticket_id: str = "0") -> Tuple[Optional[str], Optional[str]]:
+    """attachment — (имя файла, содержимое): файл уходит в IntraDesk прямо из памяти."""
     url = f"{INTRADESK_URL}/files/api/tasks/{ticket_id}/files/target/{target}?ApiKey={api_key}"
-    headers = {"Authorization": f"Bearer {INTRADESK_AUTH_TOKEN}"}
     try:
-        with open(file_path, "rb") as f:
-            files = {"file": (os.path.basename(file_path), f)}
-            r = requests.post(url, files=files, headers=headers, timeout=60)
-            r.raise_for_status()
-            j = r.json()[0]
-            return j.get("id"), j.get("name")
+        r = _ID_SESSION.post(url, files={"file": attachment}, timeout=60)
+        r.raise_for_status()
+        j = r.json()[0]
+        return j.get("id"), j.get("name")
     except Exception as e:
         logger.error("Ошибка загрузки файла: %s", e)
         return None, None
 
 
-def add_comment_to_ticket(conn, ticket_id, user_id, chat_id,
-                          comment: Optional[str] = None,
-                          file_path: Optional[str] = None,
-                          last_user_message_id: Optional[int] = None) -> bool:
+def _save_commented_ticket(conn, ticket_id, user_id, chat_id,
+                           comment: Optional[str],
+                           desired_status: Optional[int],
+                           last_user_message_id: Optional[int]) -> None:
+    # строку перечитываем после PUT (пока шёл запрос, её мог обновить idk_webhook) и переписываем
+    # в той же транзакции: BEGIN IMMEDIATE не даёт чужой записи вклиниться между чтением и записью
+    with write_tx(conn):
+        chat_id_db, user_id_db, msg_id, last_uid_msg_id_db, last_updated, status_db, last_comment_db, \
+            notified_status, last_engineer_comment, last_notified_reminder, task_number = get_ticket_info(conn, ticket_id)
+
+        effective_status = int(desired_status) if desired_status is not None else (int(status_db) if status_db is not None else OPEN_STATUS_ID)
+
+        save_ticket(conn, ticket_id, task_number, chat_id, user_id,
+                    msg_id, last_user_message_id or (last_uid_msg_id_db or 0),
+                    last_updated, effective_status,
+                    comment or (last_comment_db or ""), notified_status,
+                    last_engineer_comment, last_notified_reminder)
+
+
+async def add_comment_to_ticket(conn, ticket_id, user_id, chat_id,
+                                comment: Optional[str] = None,
+                                attachment: Optional[Tuple[str, bytes | bytearray]] = None,
+                                last_user_message_id: Optional[int] = None) -> bool:
     # текущий статус и intradesk_user_id
-    with conn:
-        c = conn.cursor()
-        c.execute("SELECT status FROM tickets WHERE ticket_id = ?", (ticket_id,))
-        row = c.fetchone()
-        current_status = int(row[0]) if row and row[0] is not None else None
-        if current_status is not None and current_status in FINAL_STATUSES:
-            logger.info("Комментарий к закрытой заявке %s (status=%s) отклонён", ticket_id, current_status)
-            return False
-
-        c.execute("SELECT intradesk_user_id FROM users WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
-        row2 = c.fetchone()
-    if not row2:
+    current_status = await _db(get_ticket_status, conn, ticket_id)
+    if current_status is not None and current_status in FINAL_STATUSES:
+        logger.info("Комментарий к закрытой заявке %s (status=%s) отклонён", ticket_id, current_status)
+        return False
+
+    if not await _db(_get_user_row, conn, user_id, chat_id):
         logger.warning("Нет intradesk_user_id для user=%s chat=%s", user_id, chat_id)
         return False
 
     data: Dict[str, Any] = {"id": ticket_id, "blocks": {}}
     if comment:
-        data["blocks"]["comment"] = f'{{"value":"{comment}"}}'
-        save_user_comment(conn, ticket_id, comment)
+        data["blocks"]["comment"] = _id_block(comment)
+        await _db(save_user_comment, conn, ticket_id, comment)
 
-    if file_path:
-        fid, fname = upload_file_to_intradesk(file_path, INTRADESK_API_KEY, "Comment", ticket_id)
+    if attachment:
+        fid, fname = await asyncio.to_thread(upload_file_to_intradesk, attachment, INTRADESK_API_KEY, "Comment", ticket_id)
         if fid:
-            size = os.path.getsize(file_path)
+            size = len(attachment[1])
             ext = os.path.splitext(fname)[1][1:]
-            data["blocks"]["attachments"] = (
-                f'{{"value":{{"addFiles":[{{"name":"{fname}","id":"{fid}","contentType":"{ext}","size":{size},"target":30}}],'
-                f'"deleteFileIds":[]}}}}'
-            )
+            data["blocks"]["attachments"] = _id_block({
+                "addFiles": [{"name": fname, "id": str(fid), "contentType": ext, "size": size, "target": 30}],
+                "deleteFileIds": [],
+            })
 
     # === АВТО-СМЕНА СТАТУСА ===
     desired_status: Optional[int] = None
@@ -687,54 +1134,48 @@ def add_comment_to_ticket(conn, ticket_id, user_id, chat_id,
         desired_status = OPEN_STATUS_ID  # у тебя в конфиге это 106939
 
     if desired_status is not None:
-        data["blocks"]["status"] = f'{{"value":{desired_status}}}'
+        data["blocks"]["status"] = _id_block(desired_status)
         logger.info("Смена статуса ticket=%s: %s -> %s из-за комментария пользователя", ticket_id, current_status, desired_status)
 
-    url = f"{TASKS_WRITE_URL}?ApiKey={INTRADESK_API_KEY}"
+    url = _ID_TASKS_WRITE_ENDPOINT
     try:
-        r = requests.put(url, json=data, headers=ID_HEADERS_JSON_W, timeout=30)
+        r = await asyncio.to_thread(_ID_SESSION.put, url, json=data, timeout=30)
         r.raise_for_status()
-
-        chat_id_db, user_id_db, msg_id, last_uid_msg_id_db, last_updated, status_db, last_comment_db, \
-            notified_status, last_engineer_comment, last_notified_reminder, task_number = get_ticket_info(conn, ticket_id)
-
-        effective_status = int(desired_status) if desired_status is not None else (int(status_db) if status_db is not None else OPEN_STATUS_ID)
-
-        save_ticket(conn, ticket_id, task_number, chat_id, user_id,
-                    msg_id, last_user_message_id or (last_uid_msg_id_db or 0),
-                    last_updated, effective_status,
-                    comment or (last_comment_db or ""), notified_status,
-                    last_engineer_comment, last_notified_reminder)
+        await _db(_save_commented_ticket, conn, ticket_id, user_id, chat_id, comment, desired_status, last_user_message_id)
         return True
     except requests.RequestException as e:
         logger.error("Ошибка добавления комментария/смены статуса: %s; resp=%s",
-                     e, getattr(e, "response", None).text if getattr(e, "response", None) else "<no response>")
+                     e, _resp_text(e))
         return False
 
 
 
 def update_ticket_evaluation(ticket_id: str, rating: str) -> bool:
-    url = f"{TASKS_WRITE_URL}?ApiKey={INTRADESK_API_KEY}"
+    url = _ID_TASKS_WRITE_ENDPOINT
     evaluation = EVALUATION_MAPPING.get(rating, {"id": 32990, "text": "Плохо"})
     data = {
         "id": ticket_id,
         "blocks": {
-            "evaluation": f"{{\"value\":{{\"value\":{rating},\"text\":\"{evaluation['text']}\"}}}}"
+            "evaluation": _id_block({"value": int(rating), "text": evaluation["text"]})
         },
     }
     try:
-        r = requests.put(url, json=data, headers=ID_HEADERS_JSON_W, timeout=30)
+        r = _ID_SESSION.put(url, json=data, timeout=30)
         r.raise_for_status()
         logger.info("Оценка для ticket_id=%s обновлена: %s", ticket_id, rating)
         return True
     except requests.RequestException as e:
-        logger.error("Ошибка обновления оценки: %s; resp=%s", e, getattr(e, "response", None).text if getattr(e, "response", None) else "<no response>")
+        logger.error("Ошибка обновления оценки: %s; resp=%s", e, _resp_text(e))
         return False
 
 # ==========================
 # Telegram handlers
 # ==========================
 
+SEND_RETRY_ATTEMPTS = 3
+SEND_RETRY_MAX_SLEEP = 30
+
+
 async def send_message(
     context: ContextTypes.DEFAULT_TYPE,
     chat_id: int,
@@ -743,76 +1184,82 @@ async def send_message(
     parse_mode: str = "HTML",
     reply_markup: Optional[Any] = None,
 ) -> Any:
+    kwargs: Dict[str, Any] = {"chat_id": chat_id, "text": text, "parse_mode": parse_mode, "reply_markup": reply_markup}
+    if chat_id < 0:
+        # в группах отвечаем на исходное сообщение, в личке — просто пишем
+        kwargs["reply_to_message_id"] = reply_to_message_id
+
+    # флуд-контроль Telegram: ждём сколько просят (не дольше SEND_RETRY_MAX_SLEEP), но не бесконечно
+    for _ in range(SEND_RETRY_ATTEMPTS):
+        try:
+            return await context.bot.send_message(**kwargs)
+        except Forbidden:
+            logger.warning("Бот исключен из чата %s, сообщение не отправлено", chat_id)
+            return None
+        except RetryAfter as e:
+            logger.warning("Too Many Requests: sleep %s", e.retry_after)
+            await asyncio.sleep(min(e.retry_after, SEND_RETRY_MAX_SLEEP))
+        except Exception as e:
+            logger.error("Ошибка отправки сообщения в чат %s: %s", chat_id, e)
+            return None
+    logger.error("Сообщение в чат %s не отправлено: лимит Telegram после %s попыток", chat_id, SEND_RETRY_ATTEMPTS)
+    return None
+
+
+async def _cleanup_service_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int, ticket_id: str) -> None:
+    """Удаляет прошлое служебное сообщение бота по заявке; запускается фоном, ответ пользователю его не ждёт."""
     try:
-        if chat_id > 0:
-            return await context.bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode, reply_markup=reply_markup)
-        else:
-            return await context.bot.send_message(
-                chat_id=chat_id,
-                text=text,
-                parse_mode=parse_mode,
-                reply_to_message_id=reply_to_message_id,
-                reply_markup=reply_markup,
-            )
-    except Forbidden:
-        logger.warning("Бот исключен из чата %s, сообщение не отправлено", chat_id)
-    except RetryAfter as e:
-        logger.warning("Too Many Requests: sleep %s", e.retry_after)
-        await asyncio.sleep(e.retry_after)
-        return await send_message(context, chat_id, text, reply_to_message_id, parse_mode, reply_markup)
+        await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
+        defer_write(clear_ticket_message_id, ticket_id)
     except Exception as e:
-        logger.error("Ошибка отправки сообщения в чат %s: %s", chat_id, e)
-        return None
+        logger.warning("Не удалось удалить сообщение %s в чате %s: %s", message_id, chat_id, e)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE, conn: sqlite3.Connection) -> None:
-    user = update.message.from_user
-    chat_id = update.message.chat_id
-    message_id = update.message.message_id
+    msg = update.message
+    user = msg.from_user
+    chat_id = msg.chat_id
+    message_id = msg.message_id
 
     if chat_id < 0:  # group/supergroup
-        if not is_group_welcomed(conn, chat_id):
+        # запись группы в БД и регистрация пользователя в IntraDesk независимы — ждём их вместе
+        pending = []
+        if not await _db(is_group_welcomed, conn, chat_id):
             full_chat = await context.bot.get_chat(chat_id)
             legal_entity_id = await register_legal_entity(chat_id, full_chat.title or str(chat_id), full_chat.description)
             if legal_entity_id:
-                mark_group_welcomed(conn, chat_id, legal_entity_id, f"telegram_group_{chat_id}")
+                pending.append(_db(mark_group_welcomed, conn, chat_id, legal_entity_id, f"telegram_group_{chat_id}"))
             else:
                 await send_message(context, chat_id, "Ошибка регистрации группы.", message_id)
                 return
         else:
-            legal_entity_id = get_legal_entity_id(conn, chat_id)
-
-        with conn:
-            c = conn.cursor()
-            c.execute("SELECT intradesk_user_id FROM users WHERE user_id = ? AND chat_id = ?", (user.id, chat_id))
-            row = c.fetchone()
-        if not row and legal_entity_id:
-            intradesk_user_id = register_legal_entity_user(conn, user.id, chat_id, user.first_name, user.username, legal_entity_id)
-            if not intradesk_user_id:
-                await send_message(context, chat_id, "Ошибка при регистрации вас как сотрудника компании.", message_id)
-                return
-        keyboard = [[KeyboardButton("Создать заявку"), KeyboardButton("Открытые заявки")]]
+            legal_entity_id = await _db(get_legal_entity_id, conn, chat_id)
+
+        row = await _db(_get_user_row, conn, user.id, chat_id)
+        register_user = not row and legal_entity_id
+        if register_user:
+            pending.append(register_legal_entity_user(conn, user.id, chat_id, user.first_name, user.username, legal_entity_id))
+        results = await asyncio.gather(*pending)
+        if register_user and not results[-1]:
+            await send_message(context, chat_id, "Ошибка при регистрации вас как сотрудника компании.", message_id)
+            return
         text = "Бот успешно добавлен в группу! Выберите действие:" if not row else "Вы уже зарегистрированы! Выберите действие:"
         await send_message(
             context,
             chat_id,
             text,
             message_id,
-            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False),
+            reply_markup=MAIN_KEYBOARD,
         )
     else:  # private chat
-        with conn:
-            c = conn.cursor()
-            c.execute("SELECT intradesk_user_id FROM users WHERE user_id = ? AND chat_id = ?", (user.id, chat_id))
-            row = c.fetchone()
+        row = await _db(_get_user_row, conn, user.id, chat_id)
         if row:
-            keyboard = [[KeyboardButton("Создать заявку"), KeyboardButton("Открытые заявки")]]
             await send_message(
                 context,
                 chat_id,
                 "Вы уже зарегистрированы! Выберите действие:",
                 message_id,
-                reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False),
+                reply_markup=MAIN_KEYBOARD,
             )
         else:
             context.user_data["awaiting_inn"] = True
@@ -821,37 +1268,77 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE, conn: sqlite
 
 async def greet_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE, conn: sqlite3.Connection) -> None:
     chat_id = update.effective_chat.id
-    message_id = update.message.message_id
-    legal_entity_id = get_legal_entity_id(conn, chat_id)
+    msg = update.message
+    message_id = msg.message_id
+    legal_entity_id = await _db(get_legal_entity_id, conn, chat_id)
     if not legal_entity_id:
         logger.warning("Группа %s не зарегистрирована как юр. лицо", chat_id)
         return
 
-    keyboard = [[KeyboardButton("Создать заявку"), KeyboardButton("Открытые заявки")]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
+    members = [m for m in msg.new_chat_members if m.id != context.bot.id and not m.is_bot]
+    # регистрации участников независимы: запросы к IntraDesk идут параллельно, ошибка одного не отменяет остальные
+    results = await asyncio.gather(
+        *(register_legal_entity_user(conn, m.id, chat_id, m.first_name, m.username, legal_entity_id) for m in members),
+        return_exceptions=True,
+    )
+    for m, intradesk_user_id in zip(members, results):
+        if isinstance(intradesk_user_id, Exception):
+            logger.error("Ошибка регистрации участника %s в чате %s: %s", m.id, chat_id, intradesk_user_id)
+            intradesk_user_id = None
+        if intradesk_user_id:
+            await send_message(context, chat_id, "Добро пожаловать в группу!\nЯ бот техподдержки. Выберите действие:", message_id, reply_markup=MAIN_KEYBOARD)
+        else:
+            await send_message(context, chat_id, "Ошибка при регистрации. Попробуйте позже или обратитесь к администратору.", message_id)
 
-    for m in update.message.new_chat_members:
-        if m.id != context.bot.id and not m.is_bot:
-            intradesk_user_id = register_legal_entity_user(conn, m.id, chat_id, m.first_name, m.username, legal_entity_id)
-            if intradesk_user_id:
-                await send_message(context, chat_id, "Добро пожаловать в группу!\nЯ бот техподдержки. Выберите действие:", message_id, reply_markup=reply_markup)
-            else:
-                await send_message(context, chat_id, "Ошибка при регистрации. Попробуйте позже или обратитесь к администратору.", message_id)
+
+async def _create_new_ticket(
+    context: ContextTypes.DEFAULT_TYPE,
+    conn: sqlite3.Connection,
+    user_id: int,
+    chat_id: int,
+    chat_title: Optional[str],
+    message_id: int,
+    reply: Callable[[str], Awaitable[Optional[int]]],
+) -> None:
+    """
+    Общий путь создания заявки для кнопки/команды и для callback "new_".
+    reply(text) показывает ответ пользователю и возвращает message_id сообщения бота (или None).
+    """
+    description = "Ожидание описания"
+    ticket_id, task_number, last_updated, status, result = await create_ticket(
+        conn,
+        "Ожидание описания",
+        description,
+        user_id,
+        chat_id,
+        chat_title if chat_id < 0 else None,
+    )
+    if not ticket_id:
+        logger.error("Не удалось создать заявку для user=%s chat=%s: %s", user_id, chat_id, result)
+        await reply(escape_html(result))
+        return
+    context.user_data["active_ticket"] = ticket_id
+    # сначала ответ пользователю: его message_id сразу уходит в строку заявки — одна запись вместо двух;
+    # finally — чтобы заявка, уже созданная в IntraDesk, попала в БД, даже если ответ упал
+    ticket_message_id = message_id
+    try:
+        ticket_message_id = await reply(f"Заявка #{task_number} создана. Опишите проблему и ожидайте ответа специалиста.") or message_id
+    finally:
+        await _db(_save_new_ticket, conn, ticket_id, task_number, chat_id, user_id, ticket_message_id, message_id,
+                  description, last_updated, status)
 
 
 async def create_ticket_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, conn: sqlite3.Connection) -> None:
-    user = update.message.from_user
-    chat_id = update.message.chat_id
-    message_id = update.message.message_id
+    msg = update.message
+    user = msg.from_user
+    chat_id = msg.chat_id
+    message_id = msg.message_id
 
-    with conn:
-        c = conn.cursor()
-        c.execute("SELECT intradesk_user_id, legal_entity_id FROM users WHERE user_id = ? AND chat_id = ?", (user.id, chat_id))
-        row = c.fetchone()
+    row = await _db(_get_user_row, conn, user.id, chat_id)
     if not row and chat_id < 0:
-        legal_entity_id = get_legal_entity_id(conn, chat_id)
+        legal_entity_id = await _db(get_legal_entity_id, conn, chat_id)
         if legal_entity_id:
-            intradesk_user_id = register_legal_entity_user(conn, user.id, chat_id, user.first_name, user.username, legal_entity_id)
+            intradesk_user_id = await register_legal_entity_user(conn, user.id, chat_id, user.first_name, user.username, legal_entity_id)
             if not intradesk_user_id:
                 await send_message(context, chat_id, "Ошибка при регистрации вас как сотрудника компании.", message_id)
                 return
@@ -863,13 +1350,10 @@ async def create_ticket_handler(update: Update, context: ContextTypes.DEFAULT_TY
         await send_message(context, chat_id, "Пожалуйста, введите ИНН вашей организации (10 или 12 цифр):", message_id)
         return
 
-    open_ticket_id = has_open_ticket(conn, user.id, chat_id)
+    open_ticket_id = await _db_read(conn, has_open_ticket, user.id, chat_id)
     if open_ticket_id:
-        with conn:
-            c = conn.cursor()
-            c.execute("SELECT task_number FROM tickets WHERE ticket_id = ?", (open_ticket_id,))
-            row2 = c.fetchone()
-            task_number = row2[0] if row2 else "Unknown"
+        ref = await _db_read(conn, get_ticket_ref, open_ticket_id)
+        task_number = ref[0] if ref else "Unknown"
         keyboard = [[
             InlineKeyboardButton("Продолжить", callback_data=f"continue_{open_ticket_id}"),
             InlineKeyboardButton("Создать новую", callback_data=f"new_{user.id}_{chat_id}"),
@@ -882,56 +1366,30 @@ async def create_ticket_handler(update: Update, context: ContextTypes.DEFAULT_TY
             reply_markup=InlineKeyboardMarkup(keyboard),
         )
     else:
-        ticket_id, last_updated, status, result = create_ticket(
-            conn,
-            "Ожидание описания",
-            "Ожидание описания",
-            user.id,
-            chat_id,
-            update.message.chat.title if chat_id < 0 else None,
-        )
-        if ticket_id:
-            with conn:
-                c = conn.cursor()
-                c.execute("SELECT task_number FROM tickets WHERE ticket_id = ?", (ticket_id,))
-                r = c.fetchone()
-                if not r:
-                    logger.error("Заявка %s не найдена в базе после создания", ticket_id)
-                    await send_message(context, chat_id, "Ошибка при создании заявки.", message_id)
-                    return
-                task_number = r[0]
-            save_ticket(conn, ticket_id, task_number, chat_id, user.id, message_id, message_id, last_updated, status)
-            context.user_data["active_ticket"] = ticket_id
-            sent = await send_message(context, chat_id, f"Заявка #{task_number} создана. Опишите проблему и ожидайте ответа специалиста.", message_id)
-            if sent:
-                with conn:
-                    c = conn.cursor()
-                    c.execute("UPDATE tickets SET message_id = ? WHERE ticket_id = ?", (sent.message_id, ticket_id))
-                    conn.commit()
-        else:
-            logger.error("Не удалось создать заявку для user=%s chat=%s: %s", user.id, chat_id, result)
-            await send_message(context, chat_id, escape_html(result), message_id)
+        async def reply(text: str) -> Optional[int]:
+            sent = await send_message(context, chat_id, text, message_id)
+            return sent.message_id if sent else None
 
+        await _create_new_ticket(context, conn, user.id, chat_id, msg.chat.title, message_id, reply)
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, conn: sqlite3.Connection) -> None:
-    user = update.message.from_user
-    chat_id = update.message.chat_id
-    message_id = update.message.message_id
-    message_text = update.message.text
 
-    if message_text == "Создать заявку":
-        await create_ticket_handler(update, context, conn)
-        return
-    if message_text == "Открытые заявки":
-        await list_tickets(update, context, conn)
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, conn: sqlite3.Connection) -> None:
+    msg = update.message
+    # правки сообщений (update.message is None) и сообщения ботов не обрабатываем — до любых запросов к БД
+    if msg is None or msg.from_user is None or msg.from_user.is_bot:
         return
+    user = msg.from_user
+    chat_id = msg.chat_id
+    message_id = msg.message_id
+    message_text = msg.text
 
     if chat_id > 0 and context.user_data.get("awaiting_inn"):
         inn = (message_text or "").strip()
-        if not re.match(r"^\d{10}$|^\d{12}$", inn):
+        # isascii отсекает юникодные цифры вроде "²"
+        if len(inn) not in _INN_LENS or not (inn.isascii() and inn.isdigit()):
             await send_message(context, chat_id, "Пожалуйста, введите корректный ИНН (10 или 12 цифр).", message_id)
             return
-        legal_entity_id = check_legal_entity_by_inn(inn)
+        legal_entity_id = await asyncio.to_thread(check_legal_entity_by_inn, inn)
         if not legal_entity_id:
             await send_message(
                 context,
@@ -940,129 +1398,85 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, con
                 message_id,
             )
             return
-        intradesk_user_id = register_legal_entity_user(conn, user.id, chat_id, user.first_name, user.username, legal_entity_id)
+        intradesk_user_id = await register_legal_entity_user(conn, user.id, chat_id, user.first_name, user.username, legal_entity_id)
         if not intradesk_user_id:
             await send_message(context, chat_id, "Ошибка при регистрации. Попробуйте позже.", message_id)
             return
         context.user_data.pop("awaiting_inn", None)
-        mark_group_welcomed(conn, chat_id, legal_entity_id, f"telegram_personal_{chat_id}")
-        keyboard = [[KeyboardButton("Создать заявку"), KeyboardButton("Открытые заявки")]]
+        await _db(mark_group_welcomed, conn, chat_id, legal_entity_id, f"telegram_personal_{chat_id}")
         await send_message(
             context,
             chat_id,
             "Вы успешно зарегистрированы! Выберите действие:",
             message_id,
-            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False),
+            reply_markup=MAIN_KEYBOARD,
         )
         return
 
-    with conn:
-        c = conn.cursor()
-        c.execute("SELECT intradesk_user_id FROM users WHERE user_id = ? AND chat_id = ?", (user.id, chat_id))
-        row = c.fetchone()
+    row = await _db(_get_user_row, conn, user.id, chat_id)
     if not row:
         await send_message(context, chat_id, "Пожалуйста, используйте /start для регистрации перед созданием заявки!", message_id)
         return
 
-    if chat_id < 0 and not context.user_data.get("active_ticket") and not has_open_ticket(conn, user.id, chat_id):
+    # открытая заявка ищется один раз и до скачивания вложений: без неё комментарий некуда добавить
+    ticket_id = context.user_data.get("active_ticket") or await _db_read(conn, has_open_ticket, user.id, chat_id)
+    if not ticket_id:
+        if chat_id > 0:
+            await send_message(context, chat_id, "Пожалуйста, нажмите на кнопку «Создать заявку»", message_id)
         return
 
-    file_path = None
-    if update.message.photo:
-        ph = await update.message.photo[-1].get_file()
-        file_path = f"temp_{user.id}_{message_id}.jpg"
-        await ph.download_to_drive(file_path)
-        message_text = update.message.caption or "Фото от пользователя"
-    elif update.message.document:
-        doc = await update.message.document.get_file()
-        safe_name = update.message.document.file_name or "file.bin"
-        file_path = f"temp_{user.id}_{message_id}_{safe_name}"
-        await doc.download_to_drive(file_path)
-        message_text = update.message.caption or "Файл от пользователя"
-    elif update.message.voice:
-        vf = await update.message.voice.get_file()
-        file_path = f"temp_{user.id}_{message_id}.ogg"
-        await vf.download_to_drive(file_path)
-        message_text = update.message.caption or "Голосовое сообщение от пользователя"
+    # вложения скачиваются в память и отдаются в IntraDesk без временных файлов на диске;
+    # bytearray requests принимает как есть — без лишней копии через bytes()
+    attachment: Optional[Tuple[str, bytes | bytearray]] = None
+    if msg.photo:
+        ph = await msg.photo[-1].get_file()
+        attachment = (f"photo_{user.id}_{message_id}.jpg", await ph.download_as_bytearray())
+        message_text = msg.caption or "Фото от пользователя"
+    elif msg.document:
+        doc = await msg.document.get_file()
+        safe_name = msg.document.file_name or "file.bin"
+        attachment = (safe_name, await doc.download_as_bytearray())
+        message_text = msg.caption or "Файл от пользователя"
+    elif msg.voice:
+        vf = await msg.voice.get_file()
+        attachment = (f"voice_{user.id}_{message_id}.ogg", await vf.download_as_bytearray())
+        message_text = msg.caption or "Голосовое сообщение от пользователя"
     elif not message_text:
         message_text = "Сообщение без текста"
 
-    ticket_id = context.user_data.get("active_ticket") or has_open_ticket(conn, user.id, chat_id)
-    if ticket_id:
-        if add_comment_to_ticket(conn, ticket_id, user.id, chat_id, message_text, file_path, message_id):
-            with conn:
-                c = conn.cursor()
-                c.execute("SELECT task_number, message_id FROM tickets WHERE ticket_id = ?", (ticket_id,))
-                r = c.fetchone()
-                ticket_message_id = r[1] if r else None
-            if ticket_message_id:
-                try:
-                    await context.bot.delete_message(chat_id=chat_id, message_id=ticket_message_id)
-                    with conn:
-                        c = conn.cursor()
-                        c.execute("UPDATE tickets SET message_id = 0 WHERE ticket_id = ?", (ticket_id,))
-                        conn.commit()
-                except Exception as e:
-                    logger.warning("Не удалось удалить сообщение %s в чате %s: %s", ticket_message_id, chat_id, e)
-        else:
-            if chat_id > 0:
-                await send_message(context, chat_id, "Пожалуйста, нажмите на кнопку «Создать заявку»", message_id)
-    else:
-        if chat_id > 0:
-            await send_message(context, chat_id, "Пожалуйста, нажмите на кнопку «Создать заявку»", message_id)
-
-    if file_path and os.path.exists(file_path):
-        try:
-            os.remove(file_path)
-        except Exception:
-            pass
+    if await add_comment_to_ticket(conn, ticket_id, user.id, chat_id, message_text, attachment, message_id):
+        ref = await _db_read(conn, get_ticket_ref, ticket_id)
+        ticket_message_id = ref[1] if ref else None
+        if ticket_message_id:
+            context.application.create_task(_cleanup_service_message(context, chat_id, ticket_message_id, ticket_id), update=update)
+    elif chat_id > 0:
+        await send_message(context, chat_id, "Пожалуйста, нажмите на кнопку «Создать заявку»", message_id)
 
 
 async def list_tickets(update: Update, context: ContextTypes.DEFAULT_TYPE, conn: sqlite3.Connection) -> None:
-    user = update.message.from_user
-    chat_id = update.message.chat_id
-    message_id = update.message.message_id
-
-    # 1) Формируем список финальных статусов (или дефолт)
-    finals = tuple(FINAL_STATUSES) if FINAL_STATUSES else (106950, 106949, 106946)
-
-    # 2) Динамически генерим плейсхолдеры под любой размер finals
-    placeholders = ",".join("?" for _ in finals)
-
-    sql = (
-        f"SELECT ticket_id, task_number, status "
-        f"FROM tickets "
-        f"WHERE user_id = ? AND chat_id = ? AND status NOT IN ({placeholders})"
-    )
+    msg = update.message
+    user = msg.from_user
+    chat_id = msg.chat_id
+    message_id = msg.message_id
 
-    with conn:
-        c = conn.cursor()
-        # 3) Параметры: (user.id, chat_id) + finals — без звёздочки+тернарника в кортеже
-        params = (user.id, chat_id) + finals
-        c.execute(sql, params)
-        rows = c.fetchall()
+    rows = await _db_read(conn, get_open_tickets, user.id, chat_id)
 
     tickets = rows or []
     if not tickets:
         await send_message(context, chat_id, "У вас нет открытых заявок.", message_id)
         return
 
-    text = "Ваши открытые заявки:\n"
+    lines = ["Ваши открытые заявки:"]
     kb: list[list[InlineKeyboardButton]] = []
     for ticket_id, task_number, status in tickets:
-        status_text = STATUSES_NAMES.get(int(status), "Неизвестный")
+        # статус — INTEGER-колонка, NULL отсекает NOT IN в запросе; имена — из словаря в памяти
         tn = task_number or "Unknown"
-        text += f"Заявка #{tn} - {status_text}\n"
+        lines.append(f"Заявка #{tn} - {STATUSES_NAMES.get(status, 'Неизвестный')}")
         kb.append([InlineKeyboardButton(f"Заявка #{tn}", callback_data=f"continue_{ticket_id}")])
 
-    sent = await send_message(context, chat_id, text, message_id, reply_markup=InlineKeyboardMarkup(kb))
+    sent = await send_message(context, chat_id, "\n".join(lines), message_id, reply_markup=InlineKeyboardMarkup(kb))
     if sent:
-        with conn:
-            c = conn.cursor()
-            for ticket_id, *_ in tickets:
-                c.execute("UPDATE tickets SET message_id = ? WHERE ticket_id = ?", (sent.message_id, ticket_id))
-            conn.commit()
-
+        defer_write(set_tickets_message_id, sent.message_id, [ticket_id for ticket_id, *_ in tickets])
 
 
 async def handle_ticket_choice(update: Update, context: ContextTypes.DEFAULT_TYPE, conn: sqlite3.Connection) -> None:
@@ -1071,76 +1485,41 @@ async def handle_ticket_choice(update: Update, context: ContextTypes.DEFAULT_TYP
     user = query.from_user
     chat_id = query.message.chat_id
 
-    action, *params = query.data.split("_")
-    if action == "continue":
-        ticket_id = params[0]
-        with conn:
-            c = conn.cursor()
-            c.execute("SELECT task_number, message_id FROM tickets WHERE ticket_id = ?", (ticket_id,))
-            row = c.fetchone()
-            task_number = row[0] if row else "Unknown"
-            ticket_message_id = row[1] if row else None
+    # callback_data: "continue_<ticket_id>" или "new_<user_id>_<chat_id>"
+    data = query.data
+    if data.startswith("continue_"):
+        ticket_id = data[len("continue_"):]
+        ref = await _db_read(conn, get_ticket_ref, ticket_id)
+        task_number = ref[0] if ref else "Unknown"
+        ticket_message_id = ref[1] if ref else None
         await query.edit_message_text(f"Выбрана заявка #{task_number}. Добавьте комментарий.", parse_mode="HTML")
         context.user_data["active_ticket"] = ticket_id
         if ticket_message_id:
-            try:
-                await context.bot.delete_message(chat_id=chat_id, message_id=ticket_message_id)
-                with conn:
-                    c = conn.cursor()
-                    c.execute("UPDATE tickets SET message_id = 0 WHERE ticket_id = ?", (ticket_id,))
-                    conn.commit()
-            except Exception as e:
-                logger.warning("Не удалось удалить сообщение %s: %s", ticket_message_id, e)
-    elif action == "new":
-        user_id, chat_id2 = map(int, params)
+            context.application.create_task(_cleanup_service_message(context, chat_id, ticket_message_id, ticket_id), update=update)
+    elif data.startswith("new_"):
+        uid_s, _, cid_s = data[len("new_"):].partition("_")
+        user_id, chat_id2 = int(uid_s), int(cid_s)
         if user_id != user.id:
             await query.edit_message_text("Вы не можете создавать заявки от имени другого пользователя!", parse_mode="HTML")
             return
-        ticket_id, last_updated, status, result = create_ticket(
-            conn,
-            "Ожидание описания",
-            "Ожидание описания",
-            user.id,
-            chat_id2,
-            query.message.chat.title if chat_id2 < 0 else None,
-        )
-        if ticket_id:
-            with conn:
-                c = conn.cursor()
-                c.execute("SELECT task_number, message_id FROM tickets WHERE ticket_id = ?", (ticket_id,))
-                row = c.fetchone()
-                if not row:
-                    logger.error("Заявка %s не найдена в БД после создания", ticket_id)
-                    text = "Ошибка при создании заявки."
-                else:
-                    task_number = row[0]
-                    ticket_message_id = row[1]
-                    save_ticket(conn, ticket_id, task_number, chat_id2, user.id, query.message.message_id, query.message.message_id, last_updated, status)
-                    text = f"Заявка #{task_number} создана. Опишите проблему и ожидайте ответа специалиста."
-                    context.user_data["active_ticket"] = ticket_id
-                    if ticket_message_id:
-                        try:
-                            await context.bot.delete_message(chat_id=chat_id2, message_id=ticket_message_id)
-                            with conn:
-                                c = conn.cursor()
-                                c.execute("UPDATE tickets SET message_id = 0 WHERE ticket_id = ?", (ticket_id,))
-                                conn.commit()
-                        except Exception as e:
-                            logger.warning("Не удалось удалить сообщение %s: %s", ticket_message_id, e)
+
+        async def reply(text: str) -> Optional[int]:
             await query.edit_message_text(text, parse_mode="HTML")
-        else:
-            await query.edit_message_text(escape_html(result), parse_mode="HTML")
+            return query.message.message_id
+
+        await _create_new_ticket(context, conn, user.id, chat_id2, query.message.chat.title, query.message.message_id, reply)
 
 
 async def handle_rating(update: Update, context: ContextTypes.DEFAULT_TYPE, conn: sqlite3.Connection) -> None:
     query = update.callback_query
     await query.answer()
-    _, ticket_id, expected_user_id, rating = query.data.split("_")
+    # "rate_<ticket_id>_<user_id>_<оценка>": режем с конца, ticket_id может содержать "_"
+    ticket_id, expected_user_id, rating = query.data[len("rate_"):].rsplit("_", 2)
     user = query.from_user
     chat_id = query.message.chat_id if query.message else update.effective_chat.id
 
     chat_id_db, user_id_db, message_id, last_user_message_id_db, last_updated, status, \
-        last_comment_db, notified_status, last_engineer_comment, last_notified_reminder, task_number = get_ticket_info(conn, ticket_id)
+        last_comment_db, notified_status, last_engineer_comment, last_notified_reminder, task_number = await _db_read(conn, get_ticket_info, ticket_id)
 
     # только владелец заявки может оценивать
     if str(user.id) != expected_user_id or user.id != user_id_db:
@@ -1151,7 +1530,7 @@ async def handle_rating(update: Update, context: ContextTypes.DEFAULT_TYPE, conn
             pass
         return
 
-    if update_ticket_evaluation(ticket_id, rating):
+    if await asyncio.to_thread(update_ticket_evaluation, ticket_id, rating):
         text = "Спасибо за оценку, ваше мнение важно для нас!"
 
         # 1) СНАЧАЛА пытаемся отредактировать сообщение с кнопками
@@ -1171,10 +1550,7 @@ async def handle_rating(update: Update, context: ContextTypes.DEFAULT_TYPE, conn
                 same_msg = query.message and (message_id == query.message.message_id)
                 if not same_msg:
                     await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-                with conn:
-                    c = conn.cursor()
-                    c.execute("UPDATE tickets SET message_id = 0 WHERE ticket_id = ?", (ticket_id,))
-                    conn.commit()
+                defer_write(clear_ticket_message_id, ticket_id)
             except Exception as e:
                 logger.warning("Не удалось удалить сообщение %s: %s", message_id, e)
     else:
@@ -1186,81 +1562,137 @@ async def handle_rating(update: Update, context: ContextTypes.DEFAULT_TYPE, conn
 
 async def check_ticket_status(context: ContextTypes.DEFAULT_TYPE, conn: sqlite3.Connection) -> None:
     try:
-        with conn:
-            c = conn.cursor()
-            c.execute(
-                """
-                SELECT ticket_id, task_number, chat_id, user_id, message_id, last_user_message_id, last_comment,
-                       last_updated, status, notified_status, last_engineer_comment, last_notified_reminder, status_changed_at
-                FROM tickets
-                """
-            )
-            tickets = c.fetchall()
+        tickets = await _db_read(conn, get_active_tickets)
 
-        for ticket in tickets or []:
-            try:
-                ticket_id = ticket[0]
-                task_number = ticket[1]
-                chat_id = ticket[2]
-                user_id = ticket[3]
-                message_id = ticket[4]
-                last_user_message_id = ticket[5]
-                last_comment = ticket[6]
-                last_updated = ticket[7]
-                status_db = int(ticket[8]) if ticket[8] is not None else OPEN_STATUS_ID
-                notified_status = ticket[9]
-                last_engineer_comment_db = ticket[10]
-                last_notified_reminder = ticket[11]
-                status_changed_at_db = ticket[12]
-
-                url = f"{TASKS_ODATA_URL}?ApiKey={INTRADESK_API_KEY}&$filter=Id eq {ticket_id}"
-                r = requests.get(url, headers=ID_HEADERS_JSON, timeout=30)
-                r.raise_for_status()
-                data = r.json()
-                if not data.get("value"):
-                    logger.warning("Заявка #%s не найдена в IntraDesk", task_number)
-                    continue
-                td = data["value"][0]
-                status = int(td.get("status", status_db))
-                updated_at = td.get("updatedat", "1970-01-01T00:00:00Z")
-
-                lifetime = (td.get("lifetime", {}) or {}).get("data", [])
-                latest_engineer_comment = None
-                latest_client_comment_time = None
-                for entry in sorted(lifetime, key=lambda x: x.get("eventat", ""), reverse=True):
-                    events = (entry.get("events", {}) or {}).get("data", [])
-                    for ev in events:
-                        comment_text = ev.get("stringvalue", "")
-                        changed_by = ev.get("changedby", "")
-                        event_time = entry.get("eventat")
-                        if ev.get("blockname") == "comment" and comment_text:
-                            if "customer_" not in changed_by and not is_user_comment(conn, ticket_id, comment_text):
-                                latest_engineer_comment = comment_text
-                                break
-                            elif "customer_" in changed_by and is_user_comment(conn, ticket_id, comment_text):
-                                latest_client_comment_time = event_time
-                    if latest_engineer_comment:
-                        break
-
-                status_changed_at = status_changed_at_db or updated_at
-                if status != status_db:
-                    status_changed_at = updated_at
-
-                if last_updated != updated_at and last_user_message_id:
-                    try:
-                        _ = await context.bot.get_chat_member(chat_id, user_id)  # existence check
-
-                        if latest_engineer_comment and latest_engineer_comment != last_engineer_comment_db and not is_user_comment(conn, ticket_id, latest_engineer_comment):
-                            await send_message(context, chat_id, escape_html(latest_engineer_comment), last_user_message_id)
-
-                        if status != status_db and status in NOTIFY_STATUSES and (notified_status is None or status != int(notified_status)):
-                            await send_message(
-                                context,
-                                chat_id,
-                                f"Заявка #{task_number} требует вашего ответа, добавьте комментарий или, если заявка уже не актуальна, мы её закроем!",
-                                last_user_message_id,
-                            )
-                            save_ticket(
+        # заявки опрашиваются параллельно; семафор ограничивает одновременные запросы к IntraDesk/Telegram
+        sem = asyncio.Semaphore(POLL_CONCURRENCY)
+        await asyncio.gather(*(_check_one_ticket(context, conn, ticket, sem) for ticket in tickets or []))
+    except Exception as e:
+        logger.error("Глобальная ошибка в check_ticket_status: %s", e, exc_info=True)
+
+
+async def _check_one_ticket(
+    context: ContextTypes.DEFAULT_TYPE,
+    conn: sqlite3.Connection,
+    ticket: sqlite3.Row,
+    sem: asyncio.Semaphore,
+) -> None:
+    async with sem:
+        try:
+            ticket_id = ticket[0]
+            task_number = ticket[1]
+            chat_id = ticket[2]
+            user_id = ticket[3]
+            message_id = ticket[4]
+            last_user_message_id = ticket[5]
+            last_comment = ticket[6]
+            last_updated = ticket[7]
+            status_db = int(ticket[8]) if ticket[8] is not None else OPEN_STATUS_ID
+            notified_status = ticket[9]
+            last_engineer_comment_db = ticket[10]
+            last_notified_reminder = ticket[11]
+            status_changed_at_db = ticket[12]
+
+            url = f"{_ID_TASKS_ODATA_ENDPOINT}&$filter=Id eq {ticket_id}"
+            r = await asyncio.to_thread(_ID_SESSION.get, url, timeout=30)
+            r.raise_for_status()
+            data = r.json()
+            if not data.get("value"):
+                logger.warning("Заявка #%s не найдена в IntraDesk", task_number)
+                return
+            td = data["value"][0]
+            status = int(td.get("status", status_db))
+            updated_at = td.get("updatedat", "1970-01-01T00:00:00Z")
+
+            lifetime = (td.get("lifetime", {}) or {}).get("data", [])
+            latest_engineer_comment = None
+            latest_client_comment_time = None
+            for entry in sorted(lifetime, key=lambda x: x.get("eventat", ""), reverse=True):
+                events = (entry.get("events", {}) or {}).get("data", [])
+                for ev in events:
+                    comment_text = ev.get("stringvalue", "")
+                    changed_by = ev.get("changedby", "")
+                    event_time = entry.get("eventat")
+                    if ev.get("blockname") == "comment" and comment_text:
+                        if "customer_" not in changed_by and not await _db_read(conn, is_user_comment, ticket_id, comment_text):
+                            latest_engineer_comment = comment_text
+                            break
+                        elif "customer_" in changed_by and await _db_read(conn, is_user_comment, ticket_id, comment_text):
+                            latest_client_comment_time = event_time
+                if latest_engineer_comment:
+                    break
+
+            status_changed_at = status_changed_at_db or updated_at
+            if status != status_db:
+                status_changed_at = updated_at
+
+            if last_updated != updated_at and last_user_message_id:
+                try:
+                    _ = await context.bot.get_chat_member(chat_id, user_id)  # existence check
+
+                    if latest_engineer_comment and latest_engineer_comment != last_engineer_comment_db and not await _db_read(conn, is_user_comment, ticket_id, latest_engineer_comment):
+                        await send_message(context, chat_id, escape_html(latest_engineer_comment), last_user_message_id)
+
+                    if status != status_db and status in NOTIFY_STATUSES and (notified_status is None or status != int(notified_status)):
+                        await send_message(
+                            context,
+                            chat_id,
+                            f"Заявка #{task_number} требует вашего ответа, добавьте комментарий или, если заявка уже не актуальна, мы её закроем!",
+                            last_user_message_id,
+                        )
+                        await _db(
+                            save_ticket,
+                            conn,
+                            ticket_id,
+                            task_number,
+                            chat_id,
+                            user_id,
+                            message_id,
+                            last_user_message_id,
+                            updated_at,
+                            status,
+                            last_comment,
+                            status,
+                            latest_engineer_comment,
+                            last_notified_reminder,
+                            status_changed_at,
+                        )
+                    elif status != status_db and status in FINAL_STATUSES:
+                        kb = [[InlineKeyboardButton(str(i), callback_data=f"rate_{ticket_id}_{user_id}_{i}") for i in range(1, 6)]]
+                        await send_message(
+                            context,
+                            chat_id,
+                            f"Заявка #{task_number} {'выполнена' if status != OPEN_STATUS_ID else 'закрыта'}! Пожалуйста, оцените качество:",
+                            last_user_message_id,
+                            reply_markup=InlineKeyboardMarkup(kb),
+                        )
+                        await _db(
+                            save_ticket,
+                            conn,
+                            ticket_id,
+                            task_number,
+                            chat_id,
+                            user_id,
+                            message_id,
+                            last_user_message_id,
+                            updated_at,
+                            status,
+                            last_comment,
+                            status,
+                            latest_engineer_comment,
+                            last_notified_reminder,
+                            status_changed_at,
+                        )
+                        if message_id:
+                            try:
+                                await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
+                                await _db(clear_ticket_message_id, conn, ticket_id)
+                            except Exception as e:
+                                logger.warning("Не удалось удалить сообщение %s в чате %s: %s", message_id, chat_id, e)
+                    else:
+                        if status != status_db or latest_engineer_comment != last_engineer_comment_db:
+                            await _db(
+                                save_ticket,
                                 conn,
                                 ticket_id,
                                 task_number,
@@ -1271,21 +1703,41 @@ async def check_ticket_status(context: ContextTypes.DEFAULT_TYPE, conn: sqlite3.
                                 updated_at,
                                 status,
                                 last_comment,
-                                status,
+                                notified_status,
                                 latest_engineer_comment,
                                 last_notified_reminder,
                                 status_changed_at,
                             )
-                        elif status != status_db and status in FINAL_STATUSES:
-                            kb = [[InlineKeyboardButton(str(i), callback_data=f"rate_{ticket_id}_{user_id}_{i}") for i in range(1, 6)]]
+                            if status in FINAL_STATUSES:
+                                await _db(clear_user_comments, conn, ticket_id)
+
+                    if status in NOTIFY_STATUSES:
+                        now = dt.datetime.now(dt.timezone.utc)
+                        status_change_time = dt.datetime.fromisoformat(status_changed_at.replace("Z", "+00:00"))
+                        time_diff = now - status_change_time
+                        has_recent_client_comment = (
+                            latest_client_comment_time
+                            and dt.datetime.fromisoformat(latest_client_comment_time.replace("Z", "+00:00")) > status_change_time
+                        )
+                        last_notified_dt = (
+                            dt.datetime.fromisoformat(last_notified_reminder.replace("Z", "+00:00"))
+                            if last_notified_reminder
+                            else None
+                        )
+
+                        if (
+                            not has_recent_client_comment
+                            and time_diff.total_seconds() >= 2 * 3600
+                            and (last_notified_dt is None or last_notified_dt < now - dt.timedelta(hours=24))
+                        ):
                             await send_message(
                                 context,
                                 chat_id,
-                                f"Заявка #{task_number} {'выполнена' if status != OPEN_STATUS_ID else 'закрыта'}! Пожалуйста, оцените качество:",
+                                f"Напоминание: заявка #{task_number} требует вашего ответа, добавьте комментарий или, если заявка уже не актуальна, мы её закроем!",
                                 last_user_message_id,
-                                reply_markup=InlineKeyboardMarkup(kb),
                             )
-                            save_ticket(
+                            await _db(
+                                save_ticket,
                                 conn,
                                 ticket_id,
                                 task_number,
@@ -1296,124 +1748,105 @@ async def check_ticket_status(context: ContextTypes.DEFAULT_TYPE, conn: sqlite3.
                                 updated_at,
                                 status,
                                 last_comment,
-                                status,
+                                notified_status,
                                 latest_engineer_comment,
-                                last_notified_reminder,
+                                now.isoformat(),
                                 status_changed_at,
                             )
-                            if message_id:
-                                try:
-                                    await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-                                    with conn:
-                                        c = conn.cursor()
-                                        c.execute("UPDATE tickets SET message_id = 0 WHERE ticket_id = ?", (ticket_id,))
-                                        conn.commit()
-                                except Exception as e:
-                                    logger.warning("Не удалось удалить сообщение %s в чате %s: %s", message_id, chat_id, e)
-                        else:
-                            if status != status_db or latest_engineer_comment != last_engineer_comment_db:
-                                save_ticket(
-                                    conn,
-                                    ticket_id,
-                                    task_number,
-                                    chat_id,
-                                    user_id,
-                                    message_id,
-                                    last_user_message_id,
-                                    updated_at,
-                                    status,
-                                    last_comment,
-                                    notified_status,
-                                    latest_engineer_comment,
-                                    last_notified_reminder,
-                                    status_changed_at,
-                                )
-                                if status in FINAL_STATUSES:
-                                    clear_user_comments(conn, ticket_id)
-
-                        if status in NOTIFY_STATUSES:
-                            now = dt.datetime.now(pytz.UTC)
-                            status_change_time = dt.datetime.fromisoformat(status_changed_at.replace("Z", "+00:00"))
-                            time_diff = now - status_change_time
-                            has_recent_client_comment = (
-                                latest_client_comment_time
-                                and dt.datetime.fromisoformat(latest_client_comment_time.replace("Z", "+00:00")) > status_change_time
-                            )
-                            last_notified_dt = (
-                                dt.datetime.fromisoformat(last_notified_reminder.replace("Z", "+00:00"))
-                                if last_notified_reminder
-                                else None
-                            )
-
-                            if (
-                                not has_recent_client_comment
-                                and time_diff.total_seconds() >= 2 * 3600
-                                and (last_notified_dt is None or last_notified_dt < now - dt.timedelta(hours=24))
-                            ):
-                                await send_message(
-                                    context,
-                                    chat_id,
-                                    f"Напоминание: заявка #{task_number} требует вашего ответа, добавьте комментарий или, если заявка уже не актуальна, мы её закроем!",
-                                    last_user_message_id,
-                                )
-                                save_ticket(
-                                    conn,
-                                    ticket_id,
-                                    task_number,
-                                    chat_id,
-                                    user_id,
-                                    message_id,
-                                    last_user_message_id,
-                                    updated_at,
-                                    status,
-                                    last_comment,
-                                    notified_status,
-                                    latest_engineer_comment,
-                                    now.isoformat(),
-                                    status_changed_at,
-                                )
-                    except Forbidden as e:
-                        logger.warning("Бот исключен из чата %s или нет доступа к пользователю %s: %s", chat_id, user_id, e)
-                    except Exception as e:
-                        logger.error("Ошибка при обработке заявки #%s в чате %s: %s", task_number, chat_id, e)
-            except Exception as e:
-                logger.error("Ошибка обработки ticket_id=%s: %s", ticket[0], e)
-                continue
-    except Exception as e:
-        logger.error("Глобальная ошибка в check_ticket_status: %s", e, exc_info=True)
+                except Forbidden as e:
+                    logger.warning("Бот исключен из чата %s или нет доступа к пользователю %s: %s", chat_id, user_id, e)
+                except Exception as e:
+                    logger.error("Ошибка при обработке заявки #%s в чате %s: %s", task_number, chat_id, e)
+        except Exception as e:
+            logger.error("Ошибка обработки ticket_id=%s: %s", ticket[0], e)
 
 
 async def handle_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE, conn: sqlite3.Connection) -> None:
     chat = update.my_chat_member.chat
-    if chat.type in ["group", "supergroup"] and update.my_chat_member.new_chat_member.status == "member" and not is_group_welcomed(conn, chat.id):
+    if chat.type in ["group", "supergroup"] and update.my_chat_member.new_chat_member.status == "member" and not await _db(is_group_welcomed, conn, chat.id):
         full_chat = await context.bot.get_chat(chat.id)
         legal_entity_id = await register_legal_entity(chat.id, full_chat.title or str(chat.id), full_chat.description)
         if legal_entity_id:
-            mark_group_welcomed(conn, chat.id, legal_entity_id, f"telegram_group_{chat.id}")
-            keyboard = [[KeyboardButton("Создать заявку"), KeyboardButton("Открытые заявки")]]
-            await send_message(
-                context,
-                chat.id,
-                "Бот успешно добавлен в группу! Выберите действие:",
-                reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False),
+            await asyncio.gather(
+                _db(mark_group_welcomed, conn, chat.id, legal_entity_id, f"telegram_group_{chat.id}"),
+                send_message(
+                    context,
+                    chat.id,
+                    "Бот успешно добавлен в группу! Выберите действие:",
+                    reply_markup=MAIN_KEYBOARD,
+                ),
             )
         else:
             await send_message(context, chat.id, "Ошибка регистрации группы.")
 
 
+# ==========================
+# Handler entry points
+# ==========================
+
+# Соединение выставляется один раз в main(); задачи PTB наследуют контекст при создании
+_CONN_CTX: ContextVar[sqlite3.Connection] = ContextVar("conn")
+
+
+async def _start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await start(update, context, _CONN_CTX.get())
+
+
+async def _create_ticket_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await create_ticket_handler(update, context, _CONN_CTX.get())
+
+
+async def _list_tickets(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await list_tickets(update, context, _CONN_CTX.get())
+
+
+async def _handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await handle_message(update, context, _CONN_CTX.get())
+
+
+async def _handle_ticket_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await handle_ticket_choice(update, context, _CONN_CTX.get())
+
+
+async def _handle_rating(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await handle_rating(update, context, _CONN_CTX.get())
+
+
+async def _handle_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await handle_my_chat_member(update, context, _CONN_CTX.get())
+
+
+async def _greet_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await greet_new_member(update, context, _CONN_CTX.get())
+
+
+async def _post_init(app: Application) -> None:
+    global _WRITE_FLUSHER
+    _WRITE_FLUSHER = asyncio.create_task(_write_flusher(_CONN_CTX.get()))
+
+
+async def _post_stop(app: Application) -> None:
+    if _WRITE_FLUSHER:
+        _WRITE_FLUSHER.cancel()
+    await _flush_writes(_CONN_CTX.get())
+
+
 # ==========================
 # Bootstrap
 # ==========================
 
 def main() -> None:
+    global _READ_POOL
     check_single_instance()
+    logger.info("Интерпретатор: %s %s", platform.python_implementation(), platform.python_version())
     conn = None
     try:
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        conn.row_factory = sqlite3.Row
+        conn = connect_db(DB_FILE)
         init_db(conn)
+        _READ_POOL = ReadPool(DB_FILE, DB_READ_POOL_SIZE)
+        _CONN_CTX.set(conn)
 
-        app = Application.builder().token(TELEGRAM_TOKEN).build()
+        app = Application.builder().token(TELEGRAM_TOKEN).post_init(_post_init).post_stop(_post_stop).build()
 
         jq = app.job_queue
 
@@ -1424,17 +1857,20 @@ def main() -> None:
         else:
            logger.info("IntraDesk polling DISABLED (enable_status_polling=0).")
 
-        jq.run_daily(clear_logs_job, time=dt.time(hour=0, minute=0, tzinfo=pytz.UTC))
-
 
         # Handlers
-        app.add_handler(CommandHandler("start", lambda upd, ctx: start(upd, ctx, conn)))
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, lambda upd, ctx: handle_message(upd, ctx, conn)))
-        app.add_handler(MessageHandler(filters.PHOTO | filters.Document.ALL | filters.VOICE, lambda upd, ctx: handle_message(upd, ctx, conn)))
-        app.add_handler(CallbackQueryHandler(lambda upd, ctx: handle_ticket_choice(upd, ctx, conn), pattern=r"^(continue|new)_"))
-        app.add_handler(CallbackQueryHandler(lambda upd, ctx: handle_rating(upd, ctx, conn), pattern=r"^rate_"))
-        app.add_handler(ChatMemberHandler(lambda upd, ctx: handle_my_chat_member(upd, ctx, conn)))
-        app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, lambda upd, ctx: greet_new_member(upd, ctx, conn)))
+        app.add_handler(CommandHandler("start", _start))
+        # кнопки меню и команды разбирают фильтры PTB — до общего текстового обработчика
+        app.add_handler(CommandHandler("new", _create_ticket_handler))
+        app.add_handler(CommandHandler(["list", "tickets"], _list_tickets))
+        app.add_handler(MessageHandler(filters.Text(["Создать заявку"]), _create_ticket_handler))
+        app.add_handler(MessageHandler(filters.Text(["Открытые заявки"]), _list_tickets))
+        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, _handle_message))
+        app.add_handler(MessageHandler(filters.PHOTO | filters.Document.ALL | filters.VOICE, _handle_message))
+        app.add_handler(CallbackQueryHandler(_handle_ticket_choice, pattern=r"^(continue|new)_"))
+        app.add_handler(CallbackQueryHandler(_handle_rating, pattern=r"^rate_"))
+        app.add_handler(ChatMemberHandler(_handle_my_chat_member))
+        app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, _greet_new_member))
 
         # Webhook (compose exposes 8080, NPM will proxy HTTPS to it)
         webhook_url = f"{PUBLIC_BASE}/{WEBHOOK_PATH}" if PUBLIC_BASE else None
@@ -1462,6 +1898,8 @@ def main() -> None:
         logger.error("Ошибка запуска бота: %s", e)
     finally:
         try:
+            if _READ_POOL:
+                _READ_POOL.close()
             if conn:
                 conn.close()
         finally: